@@ -0,0 +1,122 @@
+''' File: acBatch.py
+    Batch re-analysis of archived acBridge.py captures.
+    Finds <name>.json and <name>-resp.wav pairs, or <name>-capture.zip files, runs the calc math
+    on each in a process pool, writes one table with a row per point.
+    Usage: python acBatch.py [-o results.csv] [-j workers] [--cache dir] dir-or-glob ...
+    Output format follows the extension: .csv, .jsonl, or .parquet (needs pandas).
+'''
+
+import argparse, cmath, csv, glob, json, os, sys, time
+import concurrent.futures, functools
+import numpy
+import acCache, acCapture, acEngine
+
+# table columns, complex values are split into real and imaginary parts
+columns = ['fName', 'point', 'freqHz', 'lagS', 'zRatioRe', 'zRatioIm',
+    'r2', 'c2', 'detGainRe', 'detGainIm', 'excGain', 'rDet', 'cDet', 'error']
+
+# turn command line arguments into capture names, without extensions
+def findCaptures(args):
+    names = set()
+    for arg in args:
+        if os.path.isdir(arg):
+            paths = glob.glob(os.path.join(arg, '*-resp.wav')) + glob.glob(os.path.join(arg, '*-capture.zip'))
+        else:
+            paths = glob.glob(arg)
+        for path in paths:
+            for suffix in ('-resp.wav', '-capture.zip', '.json'):
+                if path.endswith(suffix): names.add(path[:-len(suffix)])
+    return sorted(n for n in names
+        if os.path.exists(n + '.json') and os.path.exists(n + '-resp.wav')
+        or os.path.exists(acCapture.captureName(n)))
+
+# analyze one capture, as calc would with the saved parameter tree
+# demodulated points are reused from, and saved to, the result cache in cacheDir if given
+# a capture file is read instead of wave files as calc would, its own tree used without <name>.json
+# returns a list of rows, one per point, or one row holding the error
+def analyzeCapture(name, cacheDir = None):
+    try:
+        rName = name + '-resp.wav'
+        cName = acCapture.captureName(name)
+        if os.path.exists(name + '.json'):
+            with open(name + '.json', 'r') as qFile:
+                tree = json.load(qFile)
+        else:
+            with acCapture.Capture(cName) as capture: tree = capture.tree
+        compact = os.path.exists(cName) and (tree.get('compact', False) or not os.path.exists(rName))
+        if compact: rName = cName
+        cache = acCache.ResultCache(cacheDir) if cacheDir else None
+        key = cache.key(tree, rName) if cache else None
+        cached = cache.get(key) if cache else None
+        if cached is None or len(cached[0]) < tree['numPts']:
+            if compact: points = list(acCapture.capturePoints(tree, rName))
+            else: points = list(acEngine.streamPoints(tree, rName))
+            if len(points) < tree['numPts']:
+                raise ValueError('Response has {0} of {1} points.'.format(len(points), tree['numPts']))
+            dotPrdts = numpy.array([dotPrdt for index, dotPrdt, lag in points])
+            lags = numpy.array([lag for index, dotPrdt, lag in points])
+            if cache: cache.put(key, dotPrdts, lags)
+        else:
+            dotPrdts, lags = cached
+        if not tree.get('align'): lags = None
+        rows = []
+        for n, zRatio in enumerate(acEngine.zRatios(tree, dotPrdts)):
+            dotPrdtA, dotPrdtB, dotPrdtC, dotPrdtD = map(complex, dotPrdts[n])
+            row = {'fName': name, 'point': n, 'freqHz': tree['freqHz'],
+                'lagS': None if lags is None else int(lags[n]),
+                'zRatioRe': zRatio.real, 'zRatioIm': zRatio.imag}
+            if tree.get('ref'):
+                z2, row['r2'], row['c2'] = acEngine.refImpedance(tree, complex(zRatio), tree['freqHz'])
+            if tree.get('cal'):
+                detGain, row['excGain'] = acEngine.calGains(tree, dotPrdtB, dotPrdtD)
+                row['detGainRe'], row['detGainIm'] = detGain.real, detGain.imag
+                tree.update(detGain = cmath.polar(detGain), excGain = row['excGain'])
+            if tree.get('det'):
+                zDet, row['rDet'], row['cDet'] = acEngine.detImpedance(tree, dotPrdtA, dotPrdtD)
+            rows.append(row)
+        return rows
+    except (OSError, ValueError, KeyError, ZeroDivisionError) as e:
+        return [{'fName': name, 'error': '{0}: {1}'.format(type(e).__name__, e)}]
+
+# write rows to csv, jsonl, or parquet, chosen by extension
+def writeTable(oName, rows, columns = columns):
+    if oName.endswith('.parquet'):
+        import pandas
+        pandas.DataFrame(rows, columns = columns).to_parquet(oName)
+    elif oName.endswith('.jsonl'):
+        with open(oName, 'w') as oFile:
+            for row in rows: oFile.write(json.dumps(row) + '\n')
+    else:
+        with open(oName, 'w', newline = '') as oFile:
+            writer = csv.DictWriter(oFile, fieldnames = columns)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Re-analyze acBridge captures.')
+    parser.add_argument('paths', nargs = '+', help = 'directories or globs of captures')
+    parser.add_argument('-o', '--output', default = 'batch.csv', help = '.csv, .jsonl or .parquet')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(), help = 'worker processes')
+    parser.add_argument('--cache', metavar = 'DIR', nargs = '?', const = acCache.defaultDir,
+        help = 'reuse demodulated points from DIR, acBridge cache if DIR is omitted')
+    args = parser.parse_args(argv)
+
+    names = findCaptures(args.paths)
+    print ('Found {0} captures.'.format(len(names)))
+    begin = time.perf_counter()
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers = args.jobs) as pool:
+        chunk = max(1, len(names) // (4 * args.jobs))
+        analyze = functools.partial(analyzeCapture, cacheDir = args.cache)
+        for result in pool.map(analyze, names, chunksize = chunk):
+            rows.extend(result)
+    elapsed = time.perf_counter() - begin
+    writeTable(args.output, rows)
+
+    failed = sum(1 for row in rows if 'error' in row)
+    print ('Analyzed {0} captures in {1:.3f} s, {2:.1f} files/s with {3} workers, {4} failed.'.format(
+        len(names), elapsed, len(names) / elapsed if elapsed else 0.0, args.jobs, failed))
+    print ('Results written to: {0}'.format(args.output))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
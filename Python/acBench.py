@@ -0,0 +1,328 @@
+''' File: acBench.py
+    Benchmarks for the acBridge.py signal path.
+    Runs without audio hardware, on synthetic captures.
+    Sweeps rateS, numPts and timeS over the audio callbacks of a bridge session,
+    synth, WAV load, demodulation and the full calc path, writes results as JSON,
+    and compares them against a saved baseline.
+    Exits non-zero on regressions, or when --legacy finds the stimulus not bit-identical.
+    Usage: python acBench.py [-o results.json] [-b baseline.json] [--quick] [--legacy]
+'''
+
+import argparse, contextlib, io, itertools, platform
+import math, cmath, json, os, struct, subprocess, sys, tempfile, time, types, numpy
+import acEngine, acSession
+
+# frames per callback, as opened by acBridge.py
+frameCount = 1024
+
+# fitted parameter tree, as produced by fitParams()
+def benchTree(rateS, freqHz = 160.0, phaseA = 0, phaseB = 0):
+    waveLen = 4 * (round(rateS / freqHz / 4))
+    timeS = max(4, math.ceil(rateS / 5 / waveLen)) * waveLen
+    return {
+        'rateS': rateS, 'freqHz': rateS / waveLen,
+        'quietS': rateS // 5, 'timeS': timeS, 'numCyc': timeS // waveLen,
+        'elapseS': 2 * (rateS // 5) + 2 * timeS,
+        'leftA': 12000, 'rightA': 5000, 'phaseA': phaseA,
+        'leftB': 7000.5, 'rightB': 12000, 'phaseB': phaseB}
+
+# per-sample stimulus callbacks, as acBridge.py computed them before acEngine
+def legacyCallbacks(tree):
+    omega = 2.0 * math.pi * tree['freqHz'] / tree['rateS']
+    quietS, timeS = tree['quietS'], tree['timeS']
+    n = k = 0
+    while n < tree['elapseS']:
+        frames = bytes()
+        for i in range(frameCount):
+            a = b = 0
+            if   n < quietS: k = 0
+            elif n < quietS + timeS or (2 * quietS + timeS <= n):
+                first = n < quietS + timeS
+                signal = cmath.exp(complex(0, (k + 0.5) * omega))
+                phase = cmath.exp(complex(0, tree['phaseA' if first else 'phaseB'] / 2.0))
+                a = round(tree['leftA'  if first else 'leftB']  * (signal * phase).imag)
+                b = round(tree['rightA' if first else 'rightB'] * (signal / phase).imag)
+                k += 1
+            else: k = 0
+            frames += struct.pack('<hh', a, b)
+            n += 1
+            if n == tree['elapseS']: break
+        yield frames
+
+# bridge session for one stream run of one point, as acBridge.py plays it, with no streams open
+# the callbacks only need the pyaudio flag constants, stubbed when pyaudio has not been loaded
+def benchSession(tree):
+    if acSession.pyaudio is None:
+        acSession.pyaudio = types.SimpleNamespace(paContinue = 0, paComplete = 1)
+    session = acSession.BridgeSession(dict(tree, numPts = 1, archive = False, continuous = True))
+    session.prepareRun()
+    return session
+
+# response blocks for recCall, the stimulus looped back and padded to whole callbacks
+def benchBlocks(tree):
+    frames = acEngine.stimulusFrames(tree)
+    frames = numpy.concatenate((frames, numpy.zeros((-len(frames) % frameCount, 2), dtype = '<i2')))
+    return [frames[n: n + frameCount].tobytes() for n in range(0, len(frames), frameCount)]
+
+# stimulus callbacks of a prepared session, through playCall as the audio thread calls it,
+# and recCall demodulating each block when given response blocks
+def sessionCallbacks(session, blocks = None):
+    n = 0
+    flag = acSession.pyaudio.paContinue
+    while flag != acSession.pyaudio.paComplete:
+        frames, flag = session.playCall(None, frameCount, None, 0)
+        if blocks: session.recCall(blocks[n], frameCount, None, 0)
+        n += 1
+        yield frames
+
+# time a callback generator, return microseconds per callback
+def timeCallbacks(callbacks):
+    count = 0
+    begin = time.perf_counter()
+    for frames in callbacks: count += 1
+    return 1e6 * (time.perf_counter() - begin) / count
+
+# returns the number of rates where the session stimulus differs from the legacy one
+def benchStimulus():
+    print ('Stimulus callback, {0} frames:'.format(frameCount))
+    mismatches = 0
+    for rateS in (48000, 96000, 192000):
+        tree = benchTree(rateS, phaseA = 0.3, phaseB = -1.1)
+
+        # compare complete schedules before timing
+        legacy = b''.join(legacyCallbacks(tree))
+        engine = b''.join(bytes(f) for f in sessionCallbacks(benchSession(tree)))
+        match = 'identical' if legacy == engine else 'MISMATCH'
+        if legacy != engine: mismatches += 1
+
+        # time schedule construction separately from the callbacks
+        acEngine.scheduleFrames.cache_clear()
+        begin = time.perf_counter()
+        acEngine.stimulusFrames(tree)
+        buildMs = 1e3 * (time.perf_counter() - begin)
+        print (' {0:6d} Hz: legacy {1:9.1f} us, engine {2:6.2f} us, build {3:6.1f} ms, {4}'.format(
+            rateS, timeCallbacks(legacyCallbacks(tree)),
+            timeCallbacks(sessionCallbacks(benchSession(tree))), buildMs, match))
+    return mismatches
+
+# synthetic response, stimulus looped back for numPts points
+def benchResponse(tree):
+    frames = numpy.tile(acEngine.stimulusFrames(tree), (tree['numPts'], 1))
+    return frames[:, 0], frames[:, 1]
+
+# per-point list-comprehension demodulation, as acBridge.py computed it before acEngine
+def legacyDemodulate(tree, mSeries, nSeries):
+    def dotPrdt(vec1, vec2):
+        return sum([vec1[n] * vec2[n] for n in range(len(vec1))])
+    omega = 2.0 * math.pi * tree['freqHz'] / tree['rateS']
+    refCyc = round(tree['numCyc'] / 2)
+    burstRange = tree['timeS'] * refCyc // tree['numCyc']
+    refVec = [cmath.exp(complex(0, (n + 0.5) * omega)).real for n in range(burstRange)]
+    squareNorm = dotPrdt(refVec, refVec)
+    halfPi = tree['timeS'] // tree['numCyc'] // 4
+    result = []
+    for p in range(tree['numPts']):
+        beginIA = p * tree['elapseS'] + tree['quietS'] + (tree['timeS'] // 4)
+        beginIB = p * tree['elapseS'] + (tree['quietS'] * 2) + tree['timeS'] * 5 // 4
+        point = []
+        for series in (mSeries, nSeries):
+            for begin in (beginIA, beginIB):
+                inPhase = dotPrdt(series[begin: begin + burstRange].tolist(), refVec)
+                quad = dotPrdt(series[begin + halfPi: begin + halfPi + burstRange].tolist(), refVec)
+                point.append(complex(inPhase, -quad) / squareNorm)
+        result.append([point[0], point[1], point[2], point[3]])
+    return numpy.array(result)
+
+def benchDemodulate():
+    print ('Demodulation, points per second:')
+    for rateS in (48000, 192000):
+        tree = benchTree(rateS)
+        tree['numPts'] = 4
+        mSeries, nSeries = benchResponse(tree)
+        begin = time.perf_counter()
+        legacy = legacyDemodulate(tree, mSeries, nSeries)
+        legacyRate = tree['numPts'] / (time.perf_counter() - begin)
+
+        # batch engine on many points, after filling its reference cache
+        tree['numPts'] = 1000
+        mSeries, nSeries = benchResponse(tree)
+        acEngine.demodulate(tree, mSeries, nSeries)
+        begin = time.perf_counter()
+        engine = acEngine.demodulate(tree, mSeries, nSeries)
+        engineRate = tree['numPts'] / (time.perf_counter() - begin)
+        error = numpy.max(numpy.abs(engine[:len(legacy)] - legacy) / numpy.abs(legacy))
+        print (' {0:6d} Hz: legacy {1:8.1f}, engine {2:9.1f}, relative error {3:.1e}'.format(
+            rateS, legacyRate, engineRate, error))
+
+# write a synthetic capture as <fName>.json and <fName>-resp.wav
+def writeCapture(tree):
+    mSeries, nSeries = benchResponse(tree)
+    with open(tree['fName'] + '.json', 'w') as qFile:
+        json.dump(tree, qFile, indent = 2)
+    respWave = acEngine.WaveSink(tree['fName'] + '-resp.wav', tree['rateS'], len(mSeries))
+    respWave.write(numpy.stack((mSeries, nSeries), axis = 1))
+    respWave.close()
+
+# time from a fresh interpreter importing acBridge to the end of its first calc
+startupScript = '''
+import time
+begin = time.perf_counter()
+import contextlib, io, json, sys
+sys.path.insert(0, sys.argv[1])
+import acBridge
+acBridge.pTree.update(json.load(open('bench.json')))
+with contextlib.redirect_stdout(io.StringIO()): acBridge.studyResponse()
+print (1e3 * (time.perf_counter() - begin))
+'''
+
+def benchStartup():
+    tree = dict(benchTree(48000), numPts = 4, fName = 'bench', plot = False, cacheMB = 0)
+    with tempfile.TemporaryDirectory() as tempDir:
+        tree['fName'] = os.path.join(tempDir, 'bench')
+        writeCapture(tree)
+        times = [float(subprocess.run([sys.executable, '-c', startupScript,
+            os.path.dirname(os.path.abspath(__file__))], cwd = tempDir,
+            capture_output = True, text = True, check = True).stdout) for n in range(3)]
+    print ('Import to first calc: {0:.1f} ms, best of 3'.format(min(times)))
+
+# best of repeat runs, in seconds, setup() runs untimed before each
+def bestTime(func, repeat = 3, setup = None):
+    best = math.inf
+    for n in range(repeat):
+        if setup: setup()
+        begin = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+# one sweep case: play and record callbacks of a session for one point,
+# then a capture through synth, load, demodulation and calc
+# calc runs with the result cache off, so every repeat demodulates the file
+# returns one result dict per benchmark, rate is items per second
+def benchCase(rateS, numPts, timeS, tempDir, repeat):
+    import acBridge
+    tree = benchTree(rateS)
+    tree.update(timeS = timeS, numPts = numPts, plot = False, archive = True, cacheMB = 0,
+        fName = os.path.join(tempDir, 'bench'))
+    acBridge.setDefaultParams()
+    acBridge.pTree.update(tree)
+    acBridge.fitParams()
+    tree = acBridge.pTree
+    case = {'rateS': rateS, 'numPts': numPts, 'timeS': timeS}
+    numCalls = math.ceil(tree['elapseS'] / frameCount)
+
+    def build():
+        acEngine.scheduleFrames.cache_clear()
+        acEngine.stimulusFrames(tree)
+    session = benchSession(tree)
+    blocks = benchBlocks(tree)
+    def callbacks():
+        for frames in sessionCallbacks(session, blocks): pass
+    def load():
+        mSeries, nSeries = acEngine.loadResponse(tree['fName'] + '-resp.wav', mapped = True)
+        return int(mSeries[-1]) + int(nSeries[-1])
+    mSeries = nSeries = None
+    def demod():
+        acEngine.demodulate(tree, mSeries, nSeries)
+    def calc():
+        with contextlib.redirect_stdout(io.StringIO()): acBridge.studyResponse()
+
+    results = []
+    def record(bench, seconds, items, unit):
+        results.append(dict(case, bench = bench, seconds = seconds,
+            rate = items / seconds if seconds else math.inf, unit = unit))
+
+    record('stimBuild', bestTime(build, repeat), 1, 'builds')
+    record('callback', bestTime(callbacks, repeat, session.prepareRun), numCalls, 'callbacks')
+    with contextlib.redirect_stdout(io.StringIO()):
+        record('synth', bestTime(acBridge.synthOutput, repeat), numPts * tree['elapseS'], 'frames')
+    record('load', bestTime(load, repeat), 1, 'files')
+    mSeries, nSeries = acEngine.loadResponse(tree['fName'] + '-resp.wav', mapped = True)
+    record('demod', bestTime(demod, repeat), numPts, 'points')
+    del mSeries, nSeries
+    record('calc', bestTime(calc, repeat), numPts, 'points')
+    return results
+
+# sweep all cases, skipping those whose capture would exceed maxFrames
+def runSuite(rates, points, times, maxFrames, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as tempDir:
+        for rateS, numPts, timeS in itertools.product(rates, points, times):
+            frames = numPts * 2 * (rateS // 5 + timeS)
+            if frames > maxFrames:
+                print (' {0:6d} Hz {1:5d} pts {2:6d} timeS: skipped, {3} frames'.format(
+                    rateS, numPts, timeS, frames))
+                continue
+            for result in benchCase(rateS, numPts, timeS, tempDir, repeat):
+                print (' {rateS:6d} Hz {numPts:5d} pts {timeS:6d} timeS: {bench:10s}'
+                    ' {seconds:10.6f} s {rate:14.1f} {unit}/s'.format(**result))
+                results.append(result)
+    return results
+
+# key identifying one result, for baseline comparison
+def resultKey(result):
+    return (result['bench'], result['rateS'], result['numPts'], result['timeS'])
+
+# compare results with a baseline, return number of regressions beyond tolerance
+def compareBaseline(results, baseline, tolerance):
+    base = {resultKey(r): r for r in baseline['results']}
+    regressions = 0
+    print ('Compared with baseline of {0}:'.format(baseline['meta'].get('date', 'unknown date')))
+    for result in results:
+        old = base.get(resultKey(result))
+        if not old: continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] else math.inf
+        flag = ''
+        if ratio > 1.0 + tolerance:
+            regressions += 1
+            flag = '  SLOWER'
+        elif ratio < 1.0 / (1.0 + tolerance):
+            flag = '  faster'
+        print (' {0:10s} {1:6d} Hz {2:5d} pts {3:6d} timeS: {4:6.3f}x{5}'.format(
+            *resultKey(result), ratio, flag))
+    print ('{0} regressions beyond {1:.0%}.'.format(regressions, tolerance))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Benchmark the acBridge signal path.')
+    parser.add_argument('-o', '--output', help = 'write results to this JSON file')
+    parser.add_argument('-b', '--baseline', help = 'compare with results saved by -o')
+    parser.add_argument('-t', '--tolerance', type = float, default = 0.10, help = 'slowdown reported as regression')
+    parser.add_argument('-r', '--repeat', type = int, default = 3, help = 'runs per benchmark, best is kept')
+    parser.add_argument('--rates', default = '48000,96000,192000', help = 'comma-separated rateS values')
+    parser.add_argument('--points', default = '1,10,100,1000', help = 'comma-separated numPts values')
+    parser.add_argument('--times', default = '4800,9600,19200', help = 'comma-separated timeS values')
+    parser.add_argument('--max-frames', type = int, default = 2 ** 26, help = 'largest capture to benchmark')
+    parser.add_argument('--quick', action = 'store_true', help = 'small sweep, one run per benchmark')
+    parser.add_argument('--legacy', action = 'store_true', help = 'also compare with per-sample code and time startup')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.rates, args.points, args.times, args.repeat = '48000,192000', '1,10', '9600', 1
+
+    mismatches = 0
+    if args.legacy:
+        mismatches = benchStimulus()
+        benchDemodulate()
+        benchStartup()
+
+    print ('Benchmark suite:')
+    results = runSuite([int(v) for v in args.rates.split(',')], [int(v) for v in args.points.split(',')],
+        [int(v) for v in args.times.split(',')], args.max_frames, args.repeat)
+    output = {'meta': {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(),
+        'numpy': numpy.__version__, 'machine': platform.machine(), 'platform': platform.platform(),
+        'repeat': args.repeat}, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as oFile:
+            json.dump(output, oFile, indent = 2)
+            oFile.write('\n')
+        print ('Results written to: {0}'.format(args.output))
+    failed = mismatches
+    if mismatches:
+        print ('Stimulus differs from the legacy callbacks at {0} rates.'.format(mismatches))
+    if args.baseline:
+        with open(args.baseline, 'r') as bFile:
+            failed += compareBaseline(results, json.load(bFile), args.tolerance)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -5,23 +5,29 @@
     http://www.williamsonic.com/ImpBridge/index.html
     Leveling and nulling implemented, as of 30 April 2022.
     See Linear Technology App Note 43, Jim Williams, June 1990.
+    Safe to import, audio devices open on first measurement.
+    Streams and callbacks belong to a bridge session, see acSession.py.
+    Result cache and capture file modules load on first use, keeping startup short.
 '''
 
-import math, cmath, json, matplotlib.pyplot as plot
-import os.path, pyaudio, struct, sys, time, wave
+import math, cmath, collections, json, numpy
+import os.path, queue, sys, time, wave
+import acEngine, acSession, acStats
 
 # set some global values
-pa = pyaudio.PyAudio()      # Python Audio subsystem
-stimWave = None             # stimulus wave file
-respWave = None             # response wave file
+demod = None                # streaming demodulator for last measurement
 pTree = {}                  # measurement parameter tree
 omega = 0.0                 # angular frequency, radians/sample
+plotS = 4000                # raw samples per plotted trace
+stats = acStats.Stats()     # stage timing and audio status counters
+cache = None                # demodulated results by capture and parameters
+session = acSession.BridgeSession(pTree, stats) # streams and callbacks of this bridge
+stopEvent = session.stopEvent # ends a run at the next callback
 
-# initialize default values in parameter tree
+# default values of parameter tree
 # TODO some params should allow complex values
-def setDefaultParams():
-    pTree.clear()
-    pTree.update({
+def defaultParams():
+    return {
         'rateS':     48000, # samples per second
         'quietS':     9600, # quiet time in samples
         'timeS':      9600, # excitation time in samples
@@ -37,8 +43,20 @@ def setDefaultParams():
         'zRef':      100e6, # reference impedance (assume resistance for now)
         'level':     False, # enable amplitude leveling
         'null':      False, # enable null to balance bridge
-        'ref':       False  # use reference value to calculate unknown
-    })
+        'ref':       False, # use reference value to calculate unknown
+        'archive':    True, # write stimulus and response wave files
+        'compact':   False, # archive one capture file instead of wave files
+        'align':     False, # find response lag of each point, shift burst windows to match
+        'duplex':    False, # play and record in one full-duplex stream
+        'continuous': False, # stream all points back to back without restarting
+        'cacheMB':     256, # size of demodulated result cache, zero to disable
+        'plot':       True  # plot response after analysis
+    }
+
+# initialize default values in parameter tree
+def setDefaultParams():
+    pTree.clear()
+    pTree.update(defaultParams())
 
 # start with default setup
 setDefaultParams()
@@ -58,33 +76,10 @@ def loadParamTree(cmd):
             qTree = json.load(qFile)
             if qTree: pTree.update(qTree)
 
-# check for command line argument
-if 1 < len(sys.argv):
-    loadParamTree('load ' + sys.argv[1])
-
 # apply constraints to measurement parameters
 def fitParams():
     global omega
-    # set arbitrary limits on frequency
-    if pTree['freqHz'] < 10.0: pTree['freqHz'] = 10.0
-    if pTree['freqHz'] > 10000.0: pTree['freqHz'] = 10000.0
-
-    # fit quarter wavelength to sample rate
-    waveLen = 4 * (round(pTree['rateS'] / pTree['freqHz'] / 4))
-    pTree['freqHz'] = pTree['rateS'] / waveLen
-
-    # fit number of cycles to excitation
-    pTree['numCyc'] = math.ceil(pTree['timeS'] / waveLen)
-    if pTree['numCyc'] < 4: pTree['numCyc'] = 4
-    pTree['timeS'] = pTree['numCyc'] * waveLen
-    pTree['elapseS'] = 2 * pTree['quietS'] + 2 * pTree['timeS']
-    omega = 2.0 * math.pi * pTree['freqHz'] / pTree['rateS']
-    
-    # set arbitrary limits on amplitude
-    pTree['leftA']  = min(32000, pTree['leftA'])
-    pTree['rightA'] = min(32000, pTree['rightA'])
-    pTree['leftB']  = min(32000, pTree['leftB'])
-    pTree['rightB'] = min(32000, pTree['rightB'])
+    omega = acEngine.fitParams(pTree)
 
 fitParams()
 
@@ -96,168 +91,297 @@ def saveParamTree(cmd):
         pTree['fName'] = arg
 
     # create or overwrite setup file
-    with open(pTree['fName'] + '.json', 'w') as qFile:
-        json.dump(pTree, qFile, indent = 2)
-        qFile.write('\n')
-
-# compute a frame of stimulus
-def getFrame():
-    a = b = 0
-    # initial quiet time
-    if   playCall.n < pTree['quietS']:
-        getFrame.n = 0
-
-    # first tone burst
-    elif playCall.n < (pTree['quietS'] + pTree['timeS']):
-        signal = cmath.exp(complex(0, (getFrame.n + 0.5) * omega))
-        phase = cmath.exp(complex(0, pTree['phaseA'] / 2.0))
-        a = round(pTree['leftA']  * (signal * phase).imag)
-        b = round(pTree['rightA'] * (signal / phase).imag)
-        getFrame.n += 1
-        
-    # inter-burst quiet time
-    elif playCall.n < (2 * pTree['quietS'] + pTree['timeS']):
-        getFrame.n = 0
-
-    # second tone burst
-    elif playCall.n < (2 * pTree['quietS'] + 2 * pTree['timeS']):
-        signal = cmath.exp(complex(0, (getFrame.n + 0.5) * omega))
-        phase = cmath.exp(complex(0, pTree['phaseB'] / 2.0))
-        a = round(pTree['leftB']  * (signal * phase).imag)
-        b = round(pTree['rightB'] * (signal / phase).imag)
-        getFrame.n += 1
-        
-    # shouldn't reach here
-    else:
-        print ("Shouldn't reach here.")
-    return a, b
-
-# static function variable
-getFrame.n = 0
-
-# play callback computes stimulus waveform
-def playCall(in_data, frame_count, time_info, status_flags):
-    frames = bytes()
-    theFlag = pyaudio.paContinue
-    for i in range(frame_count):
-        frames += struct.pack('<hh', *getFrame())
-        playCall.n += 1
-        if playCall.n == pTree['elapseS']:
-            theFlag = pyaudio.paComplete
-            break
-    stimWave.writeframes(frames)
-    return (frames, theFlag)
-    
-# static function variable
-playCall.n = 0
-
-# record callback captures response waveform
-def recCall(in_data, frame_count, time_info, status_flags):
-    theFlag = pyaudio.paContinue
-    if pTree['elapseS'] < (recCall.n + frame_count):
-        nFrames = pTree['elapseS'] - recCall.n
-        recCall.n += nFrames
-        nBytes = nFrames * (len(in_data) // frame_count)
-        respWave.writeframes(in_data[:nBytes])
-        theFlag = pyaudio.paComplete
-    else:
-        respWave.writeframes(in_data)
-        recCall.n += frame_count
-    return (bytes(), theFlag)
-
-# static function variable
-recCall.n = 0
-
-# send stimulus to stereo output
-playStream = pa.open(
-    format = pyaudio.paInt16,
-    channels = 2,
-    rate = pTree['rateS'],
-    frames_per_buffer = 1024,
-    stream_callback = playCall,
-    output = True,
-    start = False)
-
-# receive response from stereo input
-recStream = pa.open(
-    format = pyaudio.paInt16,
-    channels = 2,
-    rate = pTree['rateS'],
-    frames_per_buffer = 1024,
-    stream_callback = recCall,
-    input = True,
-    start = False)
-
-# wait for analog circuits to settle
-time.sleep(1.0)
-
-# check latency
-inLate = recStream.get_input_latency()
-outLate = playStream.get_output_latency()
-print (' Input latency: {0:.8f} \nOutput latency: {1:.8f}'.format(inLate, outLate))
-
-# start streaming and writing disk files
-def startStreaming():
-    global stimWave, respWave
-    # set up disk output files (wave library only supports uncompressed PCM format)
-    stimWave = wave.open(pTree['fName'] + '-stim.wav', 'wb')
-    stimWave.setparams((2, 2, pTree['rateS'], pTree['elapseS'], 'NONE', ''))
-    respWave = wave.open(pTree['fName'] + '-resp.wav', 'wb')
-    respWave.setparams((2, 2, pTree['rateS'], pTree['elapseS'], 'NONE', ''))
-    
-    # iterate over number of measurements
-    for m in range(pTree['numPts']):
-        playCall.n = recCall.n = 0
-        playStream.start_stream()
-        
-        # delay recording to account for latency
-        time.sleep(1.2 * (inLate + outLate))
-        recStream.start_stream()
-        print ('      CPU load: {0:.8f}'.format(playStream.get_cpu_load()))
+    session.saveTree()
 
-        # stop playback stream
-        while playStream.is_active(): time.sleep(0.1)
-        playStream.stop_stream()
-        print ('Playback count: {0}'.format(playCall.n))
+# start streaming in this bridge's session, keep its demodulator for analysis
+# see BridgeSession.startStreaming() for arguments
+def startStreaming(tonesHz = None, ringPts = None, onPoint = None, poll = None):
+    global demod
+    demod = session.startStreaming(tonesHz, ringPts, onPoint, poll)
 
-        # stop record stream
-        while recStream.is_active(): time.sleep(0.1)
-        recStream.stop_stream()
-        print ('  Record count: {0}'.format(recCall.n))
-
-    # close disk files
-    respWave.close()
-    stimWave.close()
+# close audio streams if open
+def closeStreams():
+    session.closeStreams()
 
 # create synthetic output for test purposes, write to disk
+# response comes from the bridge model in acEngine, see synthModel key
 def synthOutput():
-    global stimWave, respWave
+    # compact capture holds the response and the demodulated results of each point,
+    # found as acCapture.capturePoints() would, so calc need not demodulate it again
+    if pTree.get('compact', False):
+        import acCapture
+        pointTree = dict(pTree, numPts = 1)
+        lagRange = acEngine.lagRange(pTree)
+        dotPrdts, lags = [], []
+        with stats.stage('synth'):
+            sink = acCapture.CaptureSink(pTree['fName'], pTree, compress = pTree.get('compress', True))
+            for stimFrames, respFrames in acEngine.synthPoints(pTree, pTree.get('synthModel')):
+                sink.write(respFrames)
+                lag = acEngine.responseLag(pointTree, respFrames, lagRange) if pTree.get('align', False) else 0
+                dotPrdts.append(acEngine.demodulate(pointTree, respFrames[:, 0], respFrames[:, 1], lag)[0])
+                lags.append(int(lag))
+            sink.close(numpy.array(dotPrdts), lags)
+        return
+
     # set up disk output files
     stimWave = wave.open(pTree['fName'] + '-stim.wav', 'wb')
     stimWave.setparams((2, 2, pTree['rateS'], pTree['elapseS'], 'NONE', ''))
     respWave = wave.open(pTree['fName'] + '-resp.wav', 'wb')
     respWave.setparams((2, 2, pTree['rateS'], pTree['elapseS'], 'NONE', ''))
     
-    # iterate over number of measurements
-    for m in range(pTree['numPts']):
-        playCall.n = recCall.n = 0
-        for n in range(pTree['elapseS']):            
-            # write disk files
-            theFrame = getFrame()
-            stimWave.writeframes(struct.pack('<hh', *theFrame))
-            respWave.writeframes(struct.pack('<hh', *theFrame))
-            playCall.n += 1
+    # write each point in one block
+    with stats.stage('synth'):
+        for stimFrames, respFrames in acEngine.synthPoints(pTree, pTree.get('synthModel')):
+            stimWave.writeframes(stimFrames)
+            respWave.writeframes(respFrames)
             
     # close disk files
     respWave.close()
     stimWave.close()
 
-# obtain measurement output
+# obtain measurement output, report impedance ratio from streaming demodulator
+# with avgTol set, points are averaged until uncertain by less than avgTol
 def measResponse(cmd):
+    if pTree.get('avgTol'): return averageResponse(cmd)
     print (' Running: {0}'.format(pTree['fName']))
     fitParams()
     saveParamTree(cmd)
     startStreaming()
+    if not len(demod.points):
+        print (' Stopped before any point was measured.')
+        return None
+    zRatios = acEngine.zRatios(pTree, demod.dotPrdts())
+    for zRatio in zRatios:
+        print ('  zRatio: {0:.8f}'.format(zRatio))
+    results = {'dotPrdts': demod.dotPrdts(), 'zRatio': complex(zRatios[-1])}
+    if pTree.get('align', False):
+        print ('    lagS: {0}'.format(demod.lags))
+        pTree['lagS'] = results['lagS'] = demod.lags[-1]
+    return results
+
+# measure impedance ratio over a list of frequencies
+# 'sweep first last num' sets listHz to log-spaced frequencies, plain 'sweep' uses listHz as is
+# with multiTone set, all frequencies are excited together in each burst
+def sweepResponse(cmd):
+    if ' ' in cmd:
+        try:
+            firstHz, lastHz, numFreq = (float(arg) for arg in cmd.split()[1:])
+            pTree['listHz'] = acEngine.logSweep(firstHz, lastHz, numFreq)
+        except ValueError:
+            print ('Usage: sweep [firstHz lastHz numFreq]')
+            return None
+    if not pTree.get('listHz'):
+        print ('No frequencies in listHz.')
+        return None
+
+    # measure from streaming results only, restore settings when done
+    # sweep points are demodulated at other frequencies, so calc must not take them as the last measurement
+    saved = {k: pTree[k] for k in ('freqHz', 'timeS', 'archive') if k in pTree}
+    pTree['archive'] = False
+    rows = []
+    try:
+        fitParams()
+        if pTree.get('multiTone', False):
+            tonesHz = acEngine.fitTones(pTree, pTree['listHz'])
+            print (' Sweeping {0} tones at once'.format(len(tonesHz)))
+            sweepDemod = session.startStreaming(tonesHz)
+            zRatios = acEngine.zRatios(pTree, sweepDemod.dotPrdts()).mean(axis = 0)
+            rows = list(zip(tonesHz, zRatios))
+        else:
+            for freqHz in pTree['listHz']:
+                pTree.update(freqHz = freqHz, timeS = saved['timeS'])
+                fitParams()
+                sweepDemod = session.startStreaming()
+                rows.append((pTree['freqHz'], acEngine.zRatios(pTree, sweepDemod.dotPrdts()).mean()))
+    finally:
+        pTree.update(saved)
+        fitParams()
+
+    # report Z(f) table, with unknown impedance when a reference is set
+    table = []
+    print ('  freqHz            zRatio' + ('                     r2            c2' if pTree.get('ref') else ''))
+    for freqHz, zRatio in rows:
+        row = {'freqHz': freqHz, 'zRatio': complex(zRatio)}
+        line = '{0:8.2f}  {1:24.8f}'.format(freqHz, row['zRatio'])
+        if pTree.get('ref'):
+            row['z2'], row['r2'], row['c2'] = acEngine.refImpedance(pTree, row['zRatio'], freqHz)
+            line += '  {0:13.6e}  {1:13.6e}'.format(row['r2'], row['c2'])
+        print (line)
+        table.append(row)
+    return table
+
+# demodulators call onPoint from the audio or analysis thread, so only queue there
+# poll() runs on the waiting thread, calling handle(index, arrival, dotPrdts) for each queued point,
+# with arrival the perf_counter() time the point was demodulated
+# returns (onPoint, poll) for startStreaming()
+def pointQueue(handle):
+    arrived = queue.SimpleQueue()
+    def onPoint(index, dotPrdts):
+        arrived.put((index, time.perf_counter(), dotPrdts))
+    def poll():
+        while not arrived.empty():
+            handle(*arrived.get())
+    return onPoint, poll
+
+# stream points back to back until stopped, by Ctrl-C or a stop request to acServer
+# prints each point as it is demodulated, while the next one plays
+# keeps the last ringPts points, so memory stays fixed however long it runs
+def runResponse(cmd):
+    saved = {k: pTree[k] for k in ('archive',) if k in pTree}
+    pTree['archive'] = False
+    fitParams()
+    ring = collections.deque(maxlen = pTree.get('ringPts', 1000))
+    runBegin = time.perf_counter()
+
+    def handle(index, arrival, dotPrdts):
+        seconds = arrival - runBegin
+        zRatio = complex(acEngine.zRatios(pTree, dotPrdts))
+        ring.append({'point': index, 'time': seconds, 'zRatio': zRatio})
+        print (' {0:6d} {1:10.3f} s  zRatio: {2:.8f}'.format(index, seconds, zRatio))
+    onPoint, poll = pointQueue(handle)
+
+    print (' Running until stopped, Ctrl-C to stop.')
+    try:
+        startStreaming(ringPts = ring.maxlen, onPoint = onPoint, poll = poll)
+    finally:
+        pTree.update(saved)
+    poll()
+    count = ring[-1]['point'] + 1 if ring else 0
+    print (' Stopped after {0} points, {1:.3f} s.'.format(count, time.perf_counter() - runBegin))
+    if ring: pTree['zRatio'] = cmath.polar(ring[-1]['zRatio'])
+    return {'points': list(ring), 'count': count}
+
+# values averaged over points, zRatio, and z2, r2 and c2 when ref is set
+def pointValues(zRatio):
+    if pTree.get('ref'):
+        return [zRatio] + list(acEngine.refImpedance(pTree, zRatio, pTree['freqHz']))
+    return [zRatio]
+
+# relative standard error of zRatio, and of z2 when ref is set
+# r2 of a capacitor or c2 of a resistor sits near zero, so their relative errors never settle
+def averageError(running):
+    return running.relError()[:2].max()
+
+# measure points back to back, keeping a running mean and standard error of each value,
+# until the standard error of zRatio and z2 is within avgTol of their magnitude,
+# after at least minPts points, or maxPts points have been measured
+# numPts is set to the points measured, so calc can analyze the archived capture
+def averageResponse(cmd):
+    print (' Averaging: {0}'.format(pTree['fName']))
+    avgTol = pTree['avgTol']
+    minPts = max(2, pTree.get('minPts', 3))
+    maxPts = max(minPts, pTree.get('maxPts', 100))
+    saved = {k: pTree[k] for k in ('continuous',) if k in pTree}
+    pTree.update(numPts = maxPts, continuous = True)
+    fitParams()
+    saveParamTree(cmd)
+    running = acEngine.RunningMean()
+    avgBegin = time.perf_counter()
+
+    # once converged, the run ends with the point being recorded, so it is whole in the capture
+    def handle(index, arrival, dotPrdts):
+        running.add(pointValues(complex(acEngine.zRatios(pTree, dotPrdts))))
+        relError = averageError(running)
+        print (' {0:6d}  zRatio: {1:.8f} +- {2:.2e}  relError: {3:.2e}'.format(
+            index, complex(running.mean[0]), abs(running.stdErr()[0]), relError))
+        if minPts <= running.count and relError <= avgTol: session.finishPoint()
+    onPoint, poll = pointQueue(handle)
+
+    try:
+        startStreaming(onPoint = onPoint, poll = poll)
+        points = demod.points
+    finally:
+        pTree.update(saved)
+    poll()
+
+    # record the points in the capture with its parameters
+    # Ctrl-C stops within a point, which is demodulated but not whole in the capture
+    converged = minPts <= running.count and averageError(running) <= avgTol
+    pTree['numPts'] = min(len(points), session.recordedFrames() // pTree['elapseS'])
+    saveParamTree('save')
+    avgTime = time.perf_counter() - avgBegin
+    print (' {0} after {1} points, {2:.3f} s'.format(
+        'Converged' if converged else 'Not converged', running.count, avgTime))
+    if not running.count: return None
+
+    zRatio, zRatioErr = complex(running.mean[0]), complex(running.stdErr()[0])
+    pTree['zRatio'] = cmath.polar(zRatio)
+    results = {'dotPrdts': demod.dotPrdts(), 'zRatio': zRatio, 'zRatioErr': zRatioErr,
+        'relError': float(averageError(running)), 'converged': converged,
+        'count': running.count, 'seconds': avgTime}
+    if pTree.get('ref'):
+        results.update(z2 = complex(running.mean[1]), z2Err = complex(running.stdErr()[1]),
+            r2 = running.mean[2].real, r2Err = running.stdErr()[2].real,
+            c2 = running.mean[3].real, c2Err = running.stdErr()[3].real)
+        print ('Mean r2: {0} +- {1}, c2: {2} +- {3}'.format(
+            results['r2'], results['r2Err'], results['c2'], results['c2Err']))
+    return results
+
+# closed-loop leveling and nulling within one stream run, no wave files
+# points stream back to back; each demodulated point updates the excitation of the points
+# still to be played, until the level or null error is below convTol, or maxIter points
+# have been measured
+# zRatio and updates of each point use the excitation it was played with, as points in
+# flight when an update is made still play the previous excitation
+# the second burst is kept while nulling, so each point yields a fresh zRatio
+def tuneResponse(cmd):
+    if not (pTree.get('level') or pTree.get('null')):
+        print ('Set level or null to tune.')
+        return None
+    saved = {k: pTree[k] for k in ('archive',) if k in pTree}
+    pTree['archive'] = False
+    fitParams()
+    convTol = pTree.get('convTol', 1e-3)
+    maxIter = pTree.get('maxIter', 10)
+    state = {'iteration': 0, 'converged': False}
+    tuneBegin = time.perf_counter()
+
+    def handle(index, arrival, dotPrdts):
+        if state['converged'] or maxIter <= state['iteration']: return
+        tree = session.pointTree(index)
+        dotPrdtA, dotPrdtB = map(complex, dotPrdts[:2])
+        zRatio = complex(acEngine.zRatios(tree, dotPrdts))
+
+        # level error is relative to target amplitude, null error relative to second burst
+        error = 0.0
+        if pTree.get('level'):
+            error = max(error, abs(abs(dotPrdtA) / 12000.0 - 1.0), abs(abs(dotPrdtB) / 12000.0 - 1.0))
+        if pTree.get('null'):
+            error = max(error, abs(dotPrdtA) / abs(dotPrdtB))
+        state.update(iteration = state['iteration'] + 1, zRatio = zRatio, error = error)
+        print (' Iteration {0}: zRatio {1:.8f}, error {2:.3e}, {3:.3f} s'.format(
+            state['iteration'], zRatio, error, arrival - tuneBegin))
+        if error < convTol:
+            state['converged'] = True
+            stopEvent.set()
+        elif maxIter <= state['iteration']:
+            stopEvent.set()
+
+        # update excitation of points still to be played
+        else:
+            update = dict(tree)
+            if pTree.get('level'):
+                update.update(acEngine.levelUpdate(update, dotPrdtA, dotPrdtB))
+            if pTree.get('null'):
+                update.update(acEngine.nullUpdate(zRatio))
+            pTree.update({k: update[k] for k in acEngine.stimKeys})
+            session.setStimulus(pTree)
+    onPoint, poll = pointQueue(handle)
+
+    try:
+        startStreaming(ringPts = maxIter, onPoint = onPoint, poll = poll)
+    finally:
+        pTree.update(saved)
+    tuneTime = time.perf_counter() - tuneBegin
+    iteration = state['iteration']
+    if not iteration:
+        print (' Stopped before any point was measured.')
+        return None
+    pTree['zRatio'] = cmath.polar(state['zRatio'])
+    print (' {0} after {1} iterations, {2:.3f} s total, {3:.3f} s per iteration'.format(
+        'Converged' if state['converged'] else 'Not converged', iteration, tuneTime, tuneTime / iteration))
+    return {'zRatio': state['zRatio'], 'error': state['error'], 'converged': state['converged'],
+        'iterations': iteration, 'seconds': tuneTime}
 
 # obtain synthetic output
 def synthGenerate(cmd):
@@ -266,156 +390,151 @@ def synthGenerate(cmd):
     saveParamTree(cmd)
     synthOutput()
 
-# return dot product of two vectors
-def dotPrdt(vec1, vec2):
-    return sum([vec1[n] * vec2[n] for n in range(len(vec1))])
+# plot measured and fitted response for each point
+# matplotlib loads on first use, raw series are decimated to about plotS samples
+# fitted bursts are shifted by the lag of each point when aligned
+def plotResponse(mSeries, nSeries, dotPrdts, lags = None):
+    import matplotlib.pyplot as plot
+    burstRange, halfPi, begins = acEngine.burstWindows(pTree)
+    figure, thePlots = plot.subplots(pTree['numPts'], squeeze = False)
+    rawStep = max(1, pTree['elapseS'] // plotS)
+    xRaw = numpy.arange(0, pTree['elapseS'], rawStep)
+    xFit = numpy.arange(0, burstRange + halfPi, max(1, (burstRange + halfPi) // plotS))
+    signal = numpy.exp(1.0j * (xFit + 0.5) * omega)
+    startOffs = 0
+    for n in range(pTree['numPts']):
+        thePlot = thePlots[n, 0]
+
+        # plot measured response
+        thePlot.plot(xRaw, nSeries[startOffs: (startOffs + pTree['elapseS']): rawStep], '.')
+        thePlot.plot(xRaw, mSeries[startOffs: (startOffs + pTree['elapseS']): rawStep], '.')
 
-def studyResponse():
+        # plot fitted response for first burst, then second burst
+        lag = 0 if lags is None else lags[n]
+        for burst, begin in ((0, begins[0]), (2, begins[0]), (1, begins[2]), (3, begins[2])):
+            thePlot.plot(xFit + begin + lag, (dotPrdts[n, burst] * signal).real, '-')
+
+        # proceed to next measurement
+        startOffs += pTree['elapseS']
+
+    # show all
+    plot.show()
+
+# analyze response, return dict of results or None if not available
+# uses the streaming results of the last measurement when it was not archived
+def studyResponse(cmd = 'calc'):
     # update omega in radians/sample
     global omega
     omega = 2.0 * math.pi * pTree['freqHz'] / pTree['rateS']
     print ('   Omega: {0:.8f} rad/samp.'.format(omega))
+    if demod and demod.points and not pTree.get('archive', True):
+        print ('Using {0} streamed points.'.format(len(demod.points)))
+        return analyzeResponse(demod.dotPrdts())
 
-    # read measurement file into array
-    mSeries = []
-    nSeries = []
+    # read measurement file a block of points at a time
+    # 'calc follow' waits for points of a capture still being written
+    # a compact capture is read a point at a time, and only once complete
     rName = pTree['fName'] + '-resp.wav'
-    if os.path.exists(rName):
-        with wave.open(rName, 'rb') as mFile:
-            (nchannels, sampwidth, framerate, nframes, comptype, compname) = mFile.getparams()
-            while True:
-                frame = mFile.readframes(1)
-                if not len(frame): break
-                sample = struct.unpack('<hh', frame)
-                mSeries.append(sample[0])
-                nSeries.append(sample[1])
-        print ('Measurement file "{0}" has {1} samples.'.format(rName, len(mSeries)))
-    else:
+    compact = False
+    if pTree.get('compact', False) or not os.path.exists(rName):
+        import acCapture
+        cName = acCapture.captureName(pTree['fName'])
+        compact = os.path.exists(cName)
+        if compact: rName = cName
+    if not os.path.exists(rName):
         print ('Measurement file "{0}" not found.'.format(rName))
-        quit ()
-
-    # obtain amplitudes via inner product with cosine reference
-    refCyc = round(pTree['numCyc'] / 2)
-    burstRange = pTree['timeS'] * refCyc // pTree['numCyc']
-    refVec = [cmath.exp(complex(0, (n + 0.5) * omega)).real for n in range(burstRange)]
-    squareNorm = dotPrdt(refVec, refVec)
-    halfPi = pTree['timeS'] // pTree['numCyc'] // 4
-    thePlot = thePlots = None
-    if (1 < pTree['numPts']): figure, thePlots = plot.subplots(pTree['numPts'])
-    else: figure, thePlot = plot.subplots()
-    startOffs = 0
-    for n in range(pTree['numPts']):
-        # compute offsets for first burst
-        beginIA = startOffs + pTree['quietS'] + (pTree['timeS'] // 4)
-        endIA   = beginIA + burstRange
-        beginQA = beginIA + halfPi
-        endQA   = endIA + halfPi
-
-        # compute offsets for second burst
-        beginIB = startOffs + (pTree['quietS'] * 2) + pTree['timeS'] * 5 // 4
-        endIB   = beginIB + burstRange
-        beginQB = beginIB + halfPi
-        endQB   = endIB + halfPi
-        
-        vectorIA = mSeries[beginIA: endIA]
-        vectorQA = mSeries[beginQA: endQA]
-        vectorIB = mSeries[beginIB: endIB]
-        vectorQB = mSeries[beginQB: endQB]
-        vectorM  = mSeries[startOffs: (startOffs + pTree['elapseS'])]
-        
-        vectorIC = nSeries[beginIA: endIA]
-        vectorQC = nSeries[beginQA: endQA]
-        vectorID = nSeries[beginIB: endIB]
-        vectorQD = nSeries[beginQB: endQB]
-        vectorN  = nSeries[startOffs: (startOffs + pTree['elapseS'])]
-
-        # compute in-phase and quadrature components for each burst
-        dotPrdtIA = dotPrdt(vectorIA, refVec)
-        dotPrdtQA = dotPrdt(vectorQA, refVec)
-        dotPrdtIB = dotPrdt(vectorIB, refVec)
-        dotPrdtQB = dotPrdt(vectorQB, refVec)
-        
-        dotPrdtIC = dotPrdt(vectorIC, refVec)
-        dotPrdtQC = dotPrdt(vectorQC, refVec)
-        dotPrdtID = dotPrdt(vectorID, refVec)
-        dotPrdtQD = dotPrdt(vectorQD, refVec)
-
-        # combine into complex values for each burst
-        dotPrdtA = complex(dotPrdtIA, -dotPrdtQA) / squareNorm
-        dotPrdtB = complex(dotPrdtIB, -dotPrdtQB) / squareNorm
-
-        dotPrdtC = complex(dotPrdtIC, -dotPrdtQC) / squareNorm
-        dotPrdtD = complex(dotPrdtID, -dotPrdtQD) / squareNorm
-            
-        # plot measured response
-        if (thePlot):
-            thePlot.plot(list(range(0, pTree['elapseS'])), vectorN, '.')
-            thePlot.plot(list(range(0, pTree['elapseS'])), vectorM, '.')
-        else:
-            thePlots[n].plot(list(range(0, pTree['elapseS'])), vectorN, '.')
-            thePlots[n].plot(list(range(0, pTree['elapseS'])), vectorM, '.')
-
-        # plot fitted response for first burst
-        fitBurstA = [(dotPrdtA * cmath.exp(complex(0, (x + 0.5) * omega))).real for x in range(burstRange + halfPi)]
-        fitBurstC = [(dotPrdtC * cmath.exp(complex(0, (x + 0.5) * omega))).real for x in range(burstRange + halfPi)]
-        if (thePlot):
-            thePlot.plot(list(range(beginIA, endQA)), fitBurstA, '-')
-            thePlot.plot(list(range(beginIA, endQA)), fitBurstC, '-')
-        else:
-            thePlots[n].plot(list(range(beginIA-startOffs, endQA-startOffs)), fitBurstA, '-')
-            thePlots[n].plot(list(range(beginIA-startOffs, endQA-startOffs)), fitBurstC, '-')
-        
-        # plot fitted response for second burst
-        fitBurstB = [(dotPrdtB * cmath.exp(complex(0, (x + 0.5) * omega))).real for x in range(burstRange + halfPi)]
-        fitBurstD = [(dotPrdtD * cmath.exp(complex(0, (x + 0.5) * omega))).real for x in range(burstRange + halfPi)]
-        if (thePlot):
-            thePlot.plot(list(range(beginIB, endQB)), fitBurstB, '-')
-            thePlot.plot(list(range(beginIB, endQB)), fitBurstD, '-')
-        else:
-            thePlots[n].plot(list(range(beginIB-startOffs, endQB-startOffs)), fitBurstB, '-')
-            thePlots[n].plot(list(range(beginIB-startOffs, endQB-startOffs)), fitBurstD, '-')
-
-        # calculate impedance ratio
+        return None
+    follow = 'follow' in cmd.split()[1:] and not compact
+    print ('Measurement file "{0}", {1} points of {2} samples{3}.'.format(
+        rName, pTree['numPts'], pTree['elapseS'], ', following' if follow else ''))
+    points, lags = resultCache(rName) if not follow else (None, None)
+    if points is None:
+        points, lags = [], []
+        with stats.stage('demod'):
+            if compact: pointSource = acCapture.capturePoints(pTree, rName)
+            else: pointSource = acEngine.streamPoints(pTree, rName, follow)
+            for index, dotPrdts, lag in pointSource:
+                points.append(dotPrdts)
+                lags.append(lag)
+        if len(points) < pTree['numPts']:
+            print ('Response has {0} of {1} points.'.format(len(points), pTree['numPts']))
+            return None
+        resultCache(rName, points, lags)
+    else:
+        print ('Using {0} cached points.'.format(len(points)))
+    lags = [int(lag) for lag in lags]
+
+    # report the response lag of each point, when burst windows were shifted to match
+    if pTree.get('align', False):
+        print ('    lagS: {0}'.format(lags))
+        pTree['lagS'] = lags[-1]
+    lags = numpy.array(lags) if pTree.get('align', False) else None
+
+    # map measurement file into left and right channel arrays, only to plot
+    mSeries = nSeries = None
+    if pTree.get('plot', True):
+        with stats.stage('load'):
+            if compact:
+                with acCapture.Capture(rName) as capture: mSeries, nSeries = capture.series()
+            else:
+                mSeries, nSeries = acEngine.loadResponse(rName, mapped = True)
+    return analyzeResponse(numpy.array(points), mSeries, nSeries, lags)
+
+# look up demodulated points of a response file, or store them when given
+# returns (points, lags), or (None, None) if not cached or the cache is disabled
+def resultCache(rName, points = None, lags = None):
+    global cache
+    if not pTree.get('cacheMB', 256):
+        return None, None
+    import acCache
+    if not cache or cache.cDir != pTree.get('cacheDir', acCache.defaultDir):
+        cache = acCache.ResultCache(pTree.get('cacheDir', acCache.defaultDir))
+    cache.maxBytes = int(pTree.get('cacheMB', 256) * (1 << 20))
+    with stats.stage('cache'):
+        key = cache.key(pTree, rName)
+        if points is None: return cache.get(key) or (None, None)
+        cache.put(key, numpy.array(points), numpy.array(lags))
+    return points, lags
+
+# compute impedance from demodulated bursts, plot if response series are given
+def analyzeResponse(dotPrdts, mSeries = None, nSeries = None, lags = None):
+    results = {'dotPrdts': dotPrdts}
+    if lags is not None: results['lagS'] = lags
+    for n, zRatio in enumerate(acEngine.zRatios(pTree, dotPrdts)):
+        # complex values for each burst
+        dotPrdtA, dotPrdtB, dotPrdtC, dotPrdtD = map(complex, dotPrdts[n])
+
+        # report impedance ratio
         print ('      MA: {0:.8f}'.format(dotPrdtA))
         print ('      MB: {0:.8f}'.format(dotPrdtB))
         print ('      MC: {0:.8f}'.format(dotPrdtC))
         print ('      MD: {0:.8f}'.format(dotPrdtD))
-        phaseA = cmath.exp(complex(0, pTree['phaseA'] / 2.0))
-        phaseB = cmath.exp(complex(0, pTree['phaseB'] / 2.0))
-        zRatio = ((pTree['leftA'] * phaseA * dotPrdtB - pTree['leftB'] * phaseB * dotPrdtA) /
-            (pTree['rightB'] / phaseB * dotPrdtA - pTree['rightA'] / phaseA * dotPrdtB))
+        zRatio = complex(zRatio)
         print ('  zRatio: {0:.8f}'.format(zRatio))
         pTree['zRatio'] = cmath.polar(zRatio)
-        
-        # proceed to next measurement
-        startOffs += pTree['elapseS']
-                
-    # show all
-    plot.show()
+    results['zRatio'] = zRatio
+
+    # mean and standard error over all points
+    if 1 < len(dotPrdts):
+        running = acEngine.RunningMean()
+        for point in acEngine.zRatios(pTree, dotPrdts): running.add(pointValues(complex(point)))
+        results['zRatioMean'], results['zRatioErr'] = complex(running.mean[0]), complex(running.stdErr()[0])
+        print ('    Mean: {0:.8f} +- {1:.2e}, relError: {2:.2e}'.format(
+            results['zRatioMean'], abs(results['zRatioErr']), averageError(running)))
+
+    # plotting is optional, skip it when running headless
+    if pTree.get('plot', True) and mSeries is not None:
+        with stats.stage('plot'):
+            plotResponse(mSeries, nSeries, dotPrdts, lags)
     
     # check leveling after last measurement
-    # TODO try leveling etc. within one measurement
+    # use tune command to iterate within one session
     if 'level' in pTree and pTree['level']:
-        absA = abs(dotPrdtA)
-        absB = abs(dotPrdtB)
-        pTree['leftA']  = pTree['leftA']  * 12000.0 / absA
-        pTree['rightB'] = pTree['rightB'] * 12000.0 / absB
-        if 32000 < pTree['leftA']:
-            pTree['rightB'] = 32000.0 * pTree['rightB'] / pTree['leftA']
-            pTree['leftA']  = 32000
-        if 32000 < pTree['rightB']:
-            pTree['leftA']  = 32000.0 * pTree['leftA'] / pTree['rightB']
-            pTree['rightB'] = 32000
+        pTree.update(acEngine.levelUpdate(pTree, dotPrdtA, dotPrdtB))
 
     # given an impedance ratio, compute excitation to null the bridge
     if 'null' in pTree and pTree['null']:
-        magn = abs(zRatio)
-        pTree['phaseA'] = cmath.phase(zRatio)
-        pTree['leftA'] = pTree['rightA'] = 12000
-        if magn > 1.0:
-            pTree['rightA'] = -12000 / magn
-        else:
-            pTree['leftA'] = -12000 * magn
+        pTree.update(acEngine.nullUpdate(zRatio))
             
         # ignore second burst in this case
         pTree['leftB'] = pTree['rightB'] = pTree['phaseB'] = 0
@@ -424,61 +543,51 @@ def studyResponse():
     # TODO consider complex reference impedance
     if 'ref' in pTree and pTree['ref']:
         # get reference resistance from parameter tree
-        z1 = cmath.rect(pTree['zRef'], 0.0)
-        z2 = z1 / zRatio
-        print ('Ref  z1: {0}, z2: {1}'.format(z1, z2))
-
-        # compute unknown parallel resistance and capacitance
-        y2 = 1.0 / z2
-        r2 = 1.0 / y2.real
-        c2 = y2.imag / 2.0 / math.pi / pTree['freqHz']
+        z2, r2, c2 = acEngine.refImpedance(pTree, zRatio, pTree['freqHz'])
+        print ('Ref  z1: {0}, z2: {1}'.format(cmath.rect(pTree['zRef'], 0.0), z2))
+
+        # report unknown parallel resistance and capacitance
         print ('Meas r2: {0}, c2: {1}'.format(r2, c2))
+        results.update({'z2': z2, 'r2': r2, 'c2': c2})
                 
     # replace z2 with a short circuit to calibrate detector gain and phase
     # assumes right input is connected directly to right output
     if 'cal' in pTree and pTree['cal']:
-        # find detector gain as a complex value
-        detGain = dotPrdtB / dotPrdtD
+        # find detector gain as a complex value, excitation gain as an absolute value
+        detGain, excGain = acEngine.calGains(pTree, dotPrdtB, dotPrdtD)
         pTree['detGain'] = cmath.polar(detGain)
         print (' detGain: {0:.8f}'.format(detGain))
-        
-        # find excitation gain as an absolute value
-        # TODO may include phase later
-        excGain = abs(dotPrdtD) / pTree['rightB']
         pTree['excGain'] = excGain
         print (' excGain: {0:.8f}'.format(excGain))
+        results.update({'detGain': detGain, 'excGain': excGain})
         
     # replace z2 with an open circuit to obtain ratio of zDet/z1
     # assumes right input is connected directly to right output
     if 'det' in pTree and pTree['det']:
-        # find excitation vector
-        excLeft = pTree['leftA'] * cmath.rect(pTree['excGain'], cmath.phase(dotPrdtD))
-        
-        # compute detector impedance
-        detLeft = dotPrdtA / cmath.rect(*(pTree['detGain']))
-        zDetRatio = detLeft / (excLeft - detLeft)
-        z1 = cmath.rect(pTree['zRef'], 0.0)
-        zDet = z1 * zDetRatio
+        # compute detector impedance, parallel resistance and capacitance
+        zDet, rDet, cDet = acEngine.detImpedance(pTree, dotPrdtA, dotPrdtD)
         print ('zDet: {0}'.format(zDet))
-
-        # compute detector parallel resistance and capacitance
-        yDet = 1.0 / zDet
-        rDet = 1.0 / yDet.real
-        cDet = yDet.imag / 2.0 / math.pi / pTree['freqHz']
         print ('Meas rDet: {0}, cDet: {1}'.format(rDet, cDet))
+        results.update({'zDet': zDet, 'rDet': rDet, 'cDet': cDet})
+
+    return results
         
 def showHelp():
     print ('Commands available at acBridge prompt:')
-    print (' calc  -- analyze measured response')
+    print (' calc  -- analyze measured response, calc follow waits for a capture in progress')
     print (' done  -- exit this program')
     print (' fit   -- fit measurement parameters to sample rate')
     print (' help  -- present this list')
     print (' load  -- load parameter tree from disk')
-    print (' meas  -- start streaming and capturing data')
+    print (' meas  -- start streaming and capturing data, averaging until avgTol if set')
     print (' new   -- set default parameters')
+    print (' run   -- measure points back to back until stopped by Ctrl-C')
     print (' save  -- save parameter tree to disk')
     print (' show  -- display parameter tree as JSON')
+    print (' stats -- stage timing and audio status: stats [json|prom|reset]')
+    print (' sweep -- measure over listHz, or log-spaced: sweep first last num')
     print (' synth -- synthesize measurment file')
+    print (' tune  -- level or null within one stream run until converged')
     
     print ('Keynames that control measurement:')
     print (' level -- enables excitation leveling if true')
@@ -486,25 +595,66 @@ def showHelp():
     print (' ref   -- compute unknown impedance from reference if true')
     print (' cal   -- calibrate detector gain and phase if true')
     print (' det   -- compute detector impedance if true')
+    print (' plot  -- plot response after analysis if true')
+    print (' archive -- write stimulus and response wave files if true')
+    print (' compact -- archive one capture file, response and results only, if true')
+    print (' compress -- compress response in capture files if true')
+    print (' align -- find response lag of each point and shift bursts to match if true')
+    print (' duplex -- play and record in one full-duplex stream if true')
+    print (' device -- audio device index for input and output, default devices if not set')
+    print (' continuous -- play all points in one stream run if true')
+    print (' ringPts -- latest points kept by run')
+    print (' cacheMB -- size of demodulated result cache, zero to disable')
+    print (' cacheDir -- directory of result cache')
+    print (' listHz -- list of frequencies for sweep')
+    print (' multiTone -- excite all sweep frequencies at once if true')
+    print (' avgTol -- relative standard error at which meas stops averaging, zero for numPts points')
+    print (' minPts -- fewest points averaged by meas')
+    print (' maxPts -- most points averaged by meas')
+    print (' convTol -- level or null error at which tune stops')
+    print (' maxIter -- most points measured by tune')
+    print (' synthModel -- bridge model for synth, e.g. {"r2": 1e6, "c2": 1e-10, "noise": 2}')
+
+# report stage timing and audio status, as a table, JSON, or Prometheus text
+# 'stats reset' clears all counters
+# returns the summary dict, or for 'stats prom' a dict holding the Prometheus text,
+# so acServer clients can scrape it
+def showStats(cmd):
+    arg = cmd.split(' ', 1)[1].strip() if ' ' in cmd else ''
+    if arg == 'prom':
+        text = stats.toPrometheus()
+        print (text, end = '')
+        return {'text': text}
+    if   arg == 'json':  print (stats.toJson())
+    elif arg == 'reset': stats.reset()
+    else: print (stats.report())
+    return stats.summary()
+
+# first word of a command line, empty if none
+def commandWord(cmd):
+    words = cmd.split()
+    return words[0] if words else ''
+
+# run one command, as typed at the prompt, and return its result if any
+# commands match on the whole first word, so keys such as synthModel are not taken for synth
+def runCommand(cmd):
+    word = commandWord(cmd)
 
-# main control loop
-done = False
-while not done:
-    # prompt user for input
-    cmd = input("acBridge: ")
-    
     # commands, some with arguments
-    if   not cmd.find('calc'):  studyResponse()
-    elif not cmd.find('done'):  done = True
-    elif not cmd.find('fit'):   fitParams()
-    elif not cmd.find('help'):  showHelp()
-    elif not cmd.find('load'):  loadParamTree(cmd)
-    elif not cmd.find('meas'):  measResponse(cmd)
-    elif not cmd.find('new'):   setDefaultParams()
-    elif not cmd.find('save'):  saveParamTree(cmd)
-    elif not cmd.find('show'):  print (json.dumps(pTree, indent = 2))
-    elif not cmd.find('synth'): synthGenerate(cmd)
-    elif not cmd.find('?'):     showHelp()
+    if   word == 'calc':  return studyResponse(cmd)
+    elif word == 'fit':   fitParams()
+    elif word == 'help':  showHelp()
+    elif word == 'load':  loadParamTree(cmd)
+    elif word == 'meas':  return measResponse(cmd)
+    elif word == 'new':   setDefaultParams()
+    elif word == 'run':   return runResponse(cmd)
+    elif word == 'save':  saveParamTree(cmd)
+    elif word == 'show':  print (json.dumps(pTree, indent = 2))
+    elif word == 'stats': return showStats(cmd)
+    elif word == 'sweep': return sweepResponse(cmd)
+    elif word == 'synth': synthGenerate(cmd)
+    elif word == 'tune':  return tuneResponse(cmd)
+    elif word == '?':     showHelp()
     
     # look for space-separated key-value pairs
     # key names are case-sensitive, put string values in double quotes
@@ -518,8 +668,23 @@ while not done:
     # failed to parse command
     else:
         print ('Failed to parse cmd: {0}'.format(cmd))
-    
-# clean up and exit
-recStream.close()
-playStream.close()
-pa.terminate()
+    return None
+
+# main control loop
+def main():
+    # check for command line argument
+    if 1 < len(sys.argv):
+        loadParamTree('load ' + sys.argv[1])
+
+    done = False
+    while not done:
+        # prompt user for input
+        cmd = input("acBridge: ")
+        if commandWord(cmd) == 'done': done = True
+        else: runCommand(cmd)
+        
+    # clean up and exit
+    closeStreams()
+
+if __name__ == '__main__':
+    main()
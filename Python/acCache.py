@@ -0,0 +1,87 @@
+''' File: acCache.py
+    On-disk cache of demodulated captures for acBridge.py and acBatch.py.
+    Entries hold dotPrdtA..D and the lag of every point, keyed by a hash of the
+    response file and the parameters that affect demodulation.
+    Least recently used entries are removed once the cache exceeds its size.
+'''
+
+import hashlib, json, os, numpy
+
+# parameter tree keys that change demodulated results, including fitParams() output
+demodKeys = ('rateS', 'freqHz', 'quietS', 'timeS', 'numCyc', 'elapseS', 'numPts', 'align')
+
+# default location, shared by all working directories
+defaultDir = os.path.join(os.path.expanduser('~'), '.cache', 'acBridge')
+
+# content hashes by path, size and modification time, so unchanged files are hashed once
+fileHashes = {}
+
+# hash of a file's content, read in blocks
+def fileHash(fName):
+    info = os.stat(fName)
+    memo = (os.path.abspath(fName), info.st_size, info.st_mtime_ns)
+    if memo not in fileHashes:
+        digest = hashlib.blake2b(digest_size = 16)
+        with open(fName, 'rb') as hFile:
+            for block in iter(lambda: hFile.read(1 << 20), b''):
+                digest.update(block)
+        fileHashes[memo] = digest.hexdigest()
+    return fileHashes[memo]
+
+# one .npz file per entry, file modification time marks last use
+class ResultCache:
+    def __init__(self, cDir = defaultDir, maxBytes = 256 << 20):
+        self.cDir = cDir
+        self.maxBytes = maxBytes
+        os.makedirs(cDir, exist_ok = True)
+
+    # key for a response file analyzed with a parameter tree
+    def key(self, tree, rName):
+        params = json.dumps({k: tree.get(k) for k in demodKeys}, sort_keys = True)
+        digest = hashlib.blake2b(params.encode(), digest_size = 16, key = fileHash(rName).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cDir, key + '.npz')
+
+    # returns (dotPrdts, lags) or None if not cached
+    def get(self, key):
+        try:
+            with numpy.load(self.path(key)) as entry:
+                result = entry['dotPrdts'], entry['lags']
+            os.utime(self.path(key))
+            return result
+        except (OSError, KeyError, ValueError):
+            return None
+
+    # store results, written to a temporary file first so readers never see part of one
+    def put(self, key, dotPrdts, lags):
+        import tempfile
+        fd, tName = tempfile.mkstemp(dir = self.cDir, suffix = '.tmp')
+        with os.fdopen(fd, 'wb') as tFile:
+            numpy.savez(tFile, dotPrdts = dotPrdts, lags = lags)
+        os.replace(tName, self.path(key))
+        self.evict()
+
+    # remove least recently used entries until within maxBytes
+    def evict(self):
+        entries = []
+        with os.scandir(self.cDir) as scan:
+            for entry in scan:
+                if entry.name.endswith('.npz'):
+                    info = entry.stat()
+                    entries.append((info.st_mtime_ns, info.st_size, entry.path))
+        total = sum(size for used, size, path in entries)
+        for used, size, path in sorted(entries):
+            if total <= self.maxBytes: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    # remove every entry
+    def clear(self):
+        with os.scandir(self.cDir) as scan:
+            for entry in scan:
+                if entry.name.endswith('.npz'): os.remove(entry.path)
@@ -0,0 +1,234 @@
+''' File: acCapture.py
+    Compact capture files for acBridge.py, one zip file per measurement.
+    <fName>-capture.zip holds the parameter tree, the response of each point as a
+    member of its own, and the demodulated results, so point N is read on its own.
+    The stimulus is not stored, acEngine rebuilds it from the tree on demand.
+    Response members are delta coded and deflated unless stored plain, both lossless.
+    Converts <fName>.json and <fName>-resp.wav pairs, and exports captures back to them.
+    Usage: python acCapture.py [--store] [--remove] name ...
+           python acCapture.py --export name ...
+'''
+
+import argparse, json, os, queue, sys, threading, wave, zipfile, numpy
+import acCache, acEngine
+
+# capture format, bumped when members change
+version = 1
+
+# members of a capture file
+infoMember = 'capture.json'
+treeMember = 'tree.json'
+dotPrdtsMember = 'dotPrdts.npy'
+lagsMember = 'lags.npy'
+
+def pointMember(n):
+    return 'resp/{0:08d}.npy'.format(n)
+
+def captureName(fName):
+    return fName + '-capture.zip'
+
+# difference of successive frames in wrapping int16 arithmetic, small for sampled sine waves
+# so it deflates well; a cumulative sum in int16 restores the frames exactly
+def deltaEncode(frames):
+    delta = frames.copy()
+    delta[1:] -= frames[:-1]
+    return delta
+
+def deltaDecode(delta):
+    return numpy.cumsum(delta, axis = 0, dtype = '<i2')
+
+# writes frames to a capture file from a background thread, one member per point,
+# keeping compression and disk I/O off the audio thread, like acEngine.WaveSink
+# frames after the last whole point are dropped, numPts of the saved tree is the points written
+# results are taken from demod on close, unless given to close()
+class CaptureSink:
+    def __init__(self, fName, tree, demod = None, compress = True):
+        self.tree = dict(tree)
+        self.demod = demod
+        self.compress = compress
+        self.elapseS = tree['elapseS']
+        self.count = 0
+        self.zFile = zipfile.ZipFile(captureName(fName), 'w',
+            zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED, compresslevel = 1)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        point = numpy.empty((self.elapseS, 2), dtype = '<i2')
+        n = 0
+        while True:
+            frames = self.queue.get()
+            if frames is None: break
+            frames = numpy.frombuffer(frames, dtype = '<i2').reshape(-1, 2)
+            while len(frames):
+                take = min(len(frames), self.elapseS - n)
+                point[n: n + take] = frames[:take]
+                frames = frames[take:]
+                n += take
+                if n == self.elapseS:
+                    self.writeMember(pointMember(self.count), deltaEncode(point) if self.compress else point)
+                    self.count += 1
+                    n = 0
+
+    def writeMember(self, name, array):
+        with self.zFile.open(name, 'w') as mFile:
+            numpy.lib.format.write_array(mFile, numpy.ascontiguousarray(array))
+
+    # frames must not change after this call, bytes or read-only arrays are fine
+    def write(self, frames):
+        self.queue.put(frames)
+
+    # wait for queued frames, then write tree, results and index, and close the file
+    def close(self, dotPrdts = None, lags = None):
+        self.queue.put(None)
+        self.thread.join()
+        if dotPrdts is None and self.demod:
+            dotPrdts, lags = self.demod.dotPrdts(), getattr(self.demod, 'lags', None)
+        self.tree['numPts'] = self.count
+        self.zFile.writestr(treeMember, json.dumps(self.tree, indent = 2) + '\n')
+        self.zFile.writestr(infoMember, json.dumps({'version': version,
+            'points': self.count, 'elapseS': self.elapseS, 'delta': self.compress}))
+        if dotPrdts is not None and self.count <= len(dotPrdts):
+            self.writeMember(dotPrdtsMember, numpy.asarray(dotPrdts, dtype = complex)[:self.count])
+            if lags is None: lags = numpy.zeros(self.count, dtype = int)
+            self.writeMember(lagsMember, numpy.asarray(lags, dtype = int)[:self.count])
+        self.zFile.close()
+
+# reads a capture file, a point at a time
+class Capture:
+    def __init__(self, cName):
+        self.cName = cName
+        self.zFile = zipfile.ZipFile(cName, 'r')
+        self.info = json.loads(self.zFile.read(infoMember))
+        if self.info['version'] > version:
+            raise ValueError('Capture version {0} is newer than {1}: {2}'.format(
+                self.info['version'], version, cName))
+        self.tree = json.loads(self.zFile.read(treeMember))
+        self.numPts = self.info['points']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zFile.close()
+
+    def readMember(self, name):
+        with self.zFile.open(name) as mFile:
+            return numpy.lib.format.read_array(mFile)
+
+    # response of point n, an (elapseS, 2) int16 array
+    def point(self, n):
+        if not 0 <= n < self.numPts:
+            raise IndexError('Point {0} not in capture of {1} points.'.format(n, self.numPts))
+        frames = self.readMember(pointMember(n))
+        return deltaDecode(frames) if self.info['delta'] else frames
+
+    # stimulus of every point, rebuilt from the tree
+    def stimulus(self):
+        return acEngine.stimulusFrames(self.tree)
+
+    # demodulated results saved with the capture, (dotPrdts, lags) or None
+    def results(self):
+        if dotPrdtsMember not in self.zFile.namelist(): return None
+        return self.readMember(dotPrdtsMember), self.readMember(lagsMember)
+
+    # whole response as left and right channel arrays, like acEngine.loadResponse()
+    def series(self):
+        frames = numpy.concatenate([self.point(n) for n in range(self.numPts)])
+        return frames[:, 0], frames[:, 1]
+
+# demodulate a capture a point at a time, like acEngine.streamPoints() for wave files
+# saved results are used as they are when the tree demodulates as it did at capture
+# yields (index, dotPrdts, lag) for each point, lag is 0 unless the tree has align set
+def capturePoints(tree, cName):
+    with Capture(cName) as capture:
+        numPts = min(tree['numPts'], capture.numPts)
+        results = capture.results()
+        if results and all(tree.get(k) == capture.tree.get(k) for k in acCache.demodKeys if k != 'numPts'):
+            dotPrdts, lags = results
+            for n in range(numPts):
+                yield n, dotPrdts[n], int(lags[n])
+            return
+        pointTree = dict(tree, numPts = 1)
+        lags = acEngine.lagRange(tree)
+        for n in range(numPts):
+            frames = capture.point(n)
+            lag = acEngine.responseLag(pointTree, frames, lags) if tree.get('align', False) else 0
+            yield n, acEngine.demodulate(pointTree, frames[:, 0], frames[:, 1], lag)[0], int(lag)
+
+# convert <name>.json and <name>-resp.wav into <name>-capture.zip, with demodulated results
+# the capture is read back and checked against the response file before wave files are removed
+# returns (wave bytes, capture bytes)
+def convert(name, compress = True, remove = False):
+    with open(name + '.json', 'r') as qFile:
+        tree = json.load(qFile)
+    rName = name + '-resp.wav'
+    points = list(acEngine.streamPoints(tree, rName))
+    sink = CaptureSink(name, dict(tree, numPts = len(points)), compress = compress)
+    with wave.open(rName, 'rb') as rFile:
+        for n in range(len(points)):
+            sink.write(rFile.readframes(tree['elapseS']))
+    sink.close(numpy.array([dotPrdts for n, dotPrdts, lag in points]).reshape(-1, 4),
+        [lag for n, dotPrdts, lag in points])
+
+    # compare every point before anything is removed
+    mSeries, nSeries = acEngine.loadResponse(rName, mapped = True)
+    with Capture(captureName(name)) as capture:
+        for n in range(capture.numPts):
+            frames = capture.point(n)
+            span = slice(n * tree['elapseS'], (n + 1) * tree['elapseS'])
+            if not (numpy.array_equal(frames[:, 0], mSeries[span]) and numpy.array_equal(frames[:, 1], nSeries[span])):
+                raise ValueError('Capture differs from {0} at point {1}.'.format(rName, n))
+    del mSeries, nSeries
+    sizes = os.path.getsize(rName), os.path.getsize(captureName(name))
+    sName = name + '-stim.wav'
+    if os.path.exists(sName): sizes = (sizes[0] + os.path.getsize(sName), sizes[1])
+    if remove:
+        os.remove(rName)
+        if os.path.exists(sName): os.remove(sName)
+    return sizes
+
+# write <name>.json, <name>-stim.wav and <name>-resp.wav from <name>-capture.zip
+def export(name):
+    with Capture(captureName(name)) as capture:
+        with open(name + '.json', 'w') as qFile:
+            json.dump(capture.tree, qFile, indent = 2)
+            qFile.write('\n')
+        stimFrames = capture.stimulus()
+        for suffix, pointFrames in (('-stim.wav', lambda n: stimFrames), ('-resp.wav', capture.point)):
+            with wave.open(name + suffix, 'wb') as wFile:
+                wFile.setparams((2, 2, capture.tree['rateS'], capture.numPts * capture.tree['elapseS'], 'NONE', ''))
+                for n in range(capture.numPts):
+                    wFile.writeframes(pointFrames(n))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Convert acBridge wave captures to capture files, or back.')
+    parser.add_argument('names', nargs = '+', help = 'capture names, without extension')
+    parser.add_argument('--store', action = 'store_true', help = 'store response samples without compression')
+    parser.add_argument('--remove', action = 'store_true', help = 'remove wave files once converted and checked')
+    parser.add_argument('--export', action = 'store_true', help = 'write wave files and setup from capture files')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for name in args.names:
+        for suffix in ('-capture.zip', '-resp.wav', '.json'):
+            if name.endswith(suffix): name = name[:-len(suffix)]
+        try:
+            if args.export:
+                export(name)
+                print ('Exported: {0}'.format(name))
+            else:
+                waveBytes, captureBytes = convert(name, not args.store, args.remove)
+                print ('Converted: {0}, {1} to {2} bytes, {3:.1f}%'.format(
+                    name, waveBytes, captureBytes, 100.0 * captureBytes / waveBytes))
+        except (OSError, ValueError, KeyError) as e:
+            print ('Failed: {0}, {1}: {2}'.format(name, type(e).__name__, e))
+            failed += 1
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,615 @@
+''' File: acEngine.py
+    Array-based signal engine for acBridge.py.
+    Builds stimulus buffers without per-sample work in the audio callback,
+    loads response files as arrays, and demodulates bursts in batches
+    or incrementally as blocks are captured. Multi-tone bursts let
+    one capture cover several frequencies of a sweep.
+    Needs only NumPy, no audio hardware.
+'''
+
+import collections, math, cmath, functools, os, queue, struct, threading, time, wave, numpy
+
+# parameter tree keys that determine the stimulus schedule
+stimKeys = ('rateS', 'freqHz', 'quietS', 'timeS',
+    'leftA', 'rightA', 'phaseA', 'leftB', 'rightB', 'phaseB')
+
+# apply constraints to measurement parameters, updating the tree in place
+# returns angular frequency in radians/sample
+def fitParams(tree):
+    # set arbitrary limits on frequency
+    if tree['freqHz'] < 10.0: tree['freqHz'] = 10.0
+    if tree['freqHz'] > 10000.0: tree['freqHz'] = 10000.0
+
+    # fit quarter wavelength to sample rate
+    waveLen = 4 * (round(tree['rateS'] / tree['freqHz'] / 4))
+    tree['freqHz'] = tree['rateS'] / waveLen
+
+    # fit number of cycles to excitation
+    tree['numCyc'] = math.ceil(tree['timeS'] / waveLen)
+    if tree['numCyc'] < 4: tree['numCyc'] = 4
+    tree['timeS'] = tree['numCyc'] * waveLen
+    tree['elapseS'] = 2 * tree['quietS'] + 2 * tree['timeS']
+
+    # set arbitrary limits on amplitude
+    tree['leftA']  = min(32000, tree['leftA'])
+    tree['rightA'] = min(32000, tree['rightA'])
+    tree['leftB']  = min(32000, tree['leftB'])
+    tree['rightB'] = min(32000, tree['rightB'])
+    return 2.0 * math.pi * tree['freqHz'] / tree['rateS']
+
+# one cycle of the complex excitation, at the fitted wavelength
+@functools.lru_cache(maxsize = 8)
+def sineTable(waveLen):
+    omega = 2.0 * math.pi / waveLen
+    return numpy.exp(1.0j * (numpy.arange(waveLen) + 0.5) * omega)
+
+# compute one tone burst as left and right channels, same values as getFrame()
+def burstFrames(timeS, waveLen, omega, left, right, phase):
+    signal = numpy.resize(sineTable(waveLen), timeS)
+    phasor = cmath.exp(complex(0, phase / 2.0))
+    frames = numpy.empty((timeS, 2))
+    frames[:, 0] = left  * (signal * phasor).imag
+    frames[:, 1] = right * (signal / phasor).imag
+
+    # table lookup may differ from the per-sample cmath result in the last bit,
+    # which only matters near a rounding tie, so evaluate those samples exactly
+    frac = numpy.abs(frames - numpy.trunc(frames))
+    for n, c in zip(*numpy.nonzero(numpy.abs(frac - 0.5) < 1e-6)):
+        signal = cmath.exp(complex(0, (int(n) + 0.5) * omega))
+        if c: frames[n, c] = round(right * (signal / phasor).imag)
+        else: frames[n, c] = round(left  * (signal * phasor).imag)
+    return numpy.rint(frames).astype('<i2')
+
+# compute the whole quiet, burst A, quiet, burst B schedule
+@functools.lru_cache(maxsize = 4)
+def scheduleFrames(rateS, freqHz, quietS, timeS, leftA, rightA, phaseA, leftB, rightB, phaseB):
+    omega = 2.0 * math.pi * freqHz / rateS
+    waveLen = round(rateS / freqHz)
+    frames = numpy.zeros((2 * quietS + 2 * timeS, 2), dtype = '<i2')
+    frames[quietS: quietS + timeS] = burstFrames(timeS, waveLen, omega, leftA, rightA, phaseA)
+    frames[2 * quietS + timeS:] = burstFrames(timeS, waveLen, omega, leftB, rightB, phaseB)
+
+    # cached arrays are shared, so protect them
+    frames.flags.writeable = False
+    return frames
+
+# return stimulus for one measurement point as an (elapseS, 2) int16 array
+# slices of the result are contiguous and can be handed to PyAudio without copying
+def stimulusFrames(tree):
+    return scheduleFrames(*(tree[k] for k in stimKeys))
+
+# find data chunk in a RIFF/WAVE file, return (offset, size) in bytes
+def waveDataChunk(rName):
+    with open(rName, 'rb') as rFile:
+        riff, size, form = struct.unpack('<4sI4s', rFile.read(12))
+        if riff != b'RIFF' or form != b'WAVE':
+            raise ValueError('Not a WAVE file: {0}'.format(rName))
+        while True:
+            header = rFile.read(8)
+            if len(header) < 8:
+                raise ValueError('No data chunk in: {0}'.format(rName))
+            chunkId, size = struct.unpack('<4sI', header)
+            if chunkId == b'data': return rFile.tell(), size
+            rFile.seek(size + (size & 1), os.SEEK_CUR)
+
+# read a 16-bit PCM wave file in one go, or memory-map it
+# returns one int16 array per channel, each a view into the same frame buffer
+def loadResponse(rName, mapped = False):
+    with wave.open(rName, 'rb') as mFile:
+        (nchannels, sampwidth, framerate, nframes, comptype, compname) = mFile.getparams()
+        if sampwidth != 2:
+            raise ValueError('Expected 16-bit samples in: {0}'.format(rName))
+        if not mapped:
+            frames = numpy.frombuffer(mFile.readframes(nframes), dtype = '<i2')
+    if mapped:
+        offset, size = waveDataChunk(rName)
+        frames = numpy.memmap(rName, dtype = '<i2', mode = 'r', offset = offset,
+            shape = (min(size // 2, nframes * nchannels),))
+    frames = frames.reshape(-1, nchannels)
+    return tuple(frames[:, c] for c in range(nchannels))
+
+# cosine reference for in-phase and quadrature projections, with its square norm
+@functools.lru_cache(maxsize = 8)
+def refVector(omega, burstRange):
+    refVec = numpy.cos((numpy.arange(burstRange) + 0.5) * omega)
+    refVec.flags.writeable = False
+    return refVec, refVec @ refVec
+
+# burst window geometry used by studyResponse(), relative to start of each point
+# returns burstRange, halfPi, and begin offsets for IA, QA, IB, QB windows
+def burstWindows(tree):
+    refCyc = round(tree['numCyc'] / 2)
+    burstRange = tree['timeS'] * refCyc // tree['numCyc']
+    halfPi = tree['timeS'] // tree['numCyc'] // 4
+    beginIA = tree['quietS'] + (tree['timeS'] // 4)
+    beginIB = (tree['quietS'] * 2) + tree['timeS'] * 5 // 4
+    return burstRange, halfPi, (beginIA, beginIA + halfPi, beginIB, beginIB + halfPi)
+
+# project windows of a series onto the reference, a block of rows at a time
+# refVec is one reference vector, or a matrix with one reference per column
+def projectWindows(series, starts, refVec):
+    windows = numpy.lib.stride_tricks.sliding_window_view(series, len(refVec))
+    starts = starts.reshape(-1)
+    result = numpy.empty((len(starts),) + refVec.shape[1:], dtype = refVec.dtype)
+    block = max(1, (1 << 22) // len(refVec))
+    for n in range(0, len(starts), block):
+        result[n: n + block] = windows[starts[n: n + block]] @ refVec
+    return result
+
+# range of response lags, in samples, that keep every burst window inside its point
+def lagRange(tree):
+    burstRange, halfPi, begins = burstWindows(tree)
+    return -min(begins), tree['elapseS'] - max(begins) - burstRange
+
+# round-trip offset of one point of response, by correlation with the carrier of each burst
+# each response channel is mixed down by the carrier and averaged over half a cycle, which
+# cancels the image at twice the carrier frequency; sums over every shifted burst window then
+# come from one cumulative sum, so the peak follows burst envelopes, not carrier phase or
+# the mix of channels set by the bridge
+# sums are normalized by the part of each window inside the response, a least squares fit
+# with one complex gain per channel and burst
+# returns the lag within lags = (lo, hi) of best fit, positive when the response is late
+def responseLag(tree, respFrames, lags):
+    omega = 2.0 * math.pi * tree['freqHz'] / tree['rateS']
+    halfS = round(math.pi / omega)
+    quietS, timeS = tree['quietS'], tree['timeS']
+    respLen = len(respFrames)
+    mixed = numpy.asarray(respFrames, dtype = float) * numpy.exp(-1.0j * numpy.arange(respLen) * omega)[:, None]
+    sums = numpy.cumsum(numpy.concatenate((numpy.zeros((halfS // 2 + 1, mixed.shape[1])),
+        mixed, numpy.zeros((halfS - halfS // 2, mixed.shape[1])))), axis = 0)
+    sums = numpy.cumsum((sums[halfS:] - sums[:-halfS]) / halfS, axis = 0)
+    sums = numpy.concatenate((numpy.zeros((1, mixed.shape[1])), sums[:respLen]))
+
+    lo, hi = lags
+    candidates = numpy.arange(lo, hi + 1)
+    score = numpy.zeros(len(candidates))
+    for begin in (quietS, 2 * quietS + timeS):
+        first = numpy.clip(begin + candidates, 0, respLen)
+        last = numpy.clip(begin + candidates + timeS, 0, respLen)
+        count = last - first
+        valid = count > 0
+        corr = sums[last[valid]] - sums[first[valid]]
+        score[valid] += (numpy.abs(corr) ** 2).sum(axis = 1) / count[valid]
+    return int(candidates[numpy.argmax(score)])
+
+# response lag of each point of a capture
+# returns an int array with one lag per point, within lagRange()
+def pointLags(tree, mSeries, nSeries):
+    elapseS, lags = tree['elapseS'], lagRange(tree)
+    return numpy.array([responseLag(tree, numpy.stack(
+        (mSeries[p * elapseS: (p + 1) * elapseS], nSeries[p * elapseS: (p + 1) * elapseS]), axis = 1), lags)
+        for p in range(tree['numPts'])], dtype = int)
+
+# demodulate all bursts of all points in one batch
+# startOffs shifts the windows of all points, or of each point when given one offset per point
+# returns a (numPts, 4) complex array holding dotPrdtA, B (left) and C, D (right)
+def demodulate(tree, mSeries, nSeries, startOffs = 0):
+    omega = 2.0 * math.pi * tree['freqHz'] / tree['rateS']
+    burstRange, halfPi, begins = burstWindows(tree)
+    refVec, squareNorm = refVector(omega, burstRange)
+
+    # check that every window of every point is in the series
+    numPts = tree['numPts']
+    starts = (startOffs + tree['elapseS'] * numpy.arange(numPts))[:, None] + numpy.array(begins)
+    if starts.min() < 0:
+        raise ValueError('Burst window begins {0} samples before response.'.format(-starts.min()))
+    if len(mSeries) < starts.max() + burstRange:
+        raise ValueError('Response has {0} samples, {1} points need {2}.'.format(
+            len(mSeries), numPts, starts.max() + burstRange))
+
+    # combine in-phase and quadrature projections into complex values per burst
+    dotPrdts = numpy.empty((numPts, 4), dtype = complex)
+    for c, series in enumerate((mSeries, nSeries)):
+        proj = projectWindows(numpy.asarray(series), starts, refVec).reshape(numPts, 4)
+        dotPrdts[:, 2 * c]     = (proj[:, 0] - 1.0j * proj[:, 1]) / squareNorm
+        dotPrdts[:, 2 * c + 1] = (proj[:, 2] - 1.0j * proj[:, 3]) / squareNorm
+    return dotPrdts
+
+# impedance ratio from dotPrdtA..D, for one point or an array of points
+def zRatios(tree, dotPrdts):
+    dotPrdtA, dotPrdtB = dotPrdts[..., 0], dotPrdts[..., 1]
+    phaseA = cmath.exp(complex(0, tree['phaseA'] / 2.0))
+    phaseB = cmath.exp(complex(0, tree['phaseB'] / 2.0))
+    return ((tree['leftA'] * phaseA * dotPrdtB - tree['leftB'] * phaseB * dotPrdtA) /
+        (tree['rightB'] / phaseB * dotPrdtA - tree['rightA'] / phaseA * dotPrdtB))
+
+# running mean and standard error of a vector of values, complex or real, one point at a time
+# real and imaginary parts are spread independently, by Welford's method
+class RunningMean:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0       # sums of squared deviations, real part in real, imaginary in imag
+
+    def add(self, values):
+        values = numpy.asarray(values, dtype = complex)
+        self.count += 1
+        delta = values - self.mean
+        self.mean = self.mean + delta / self.count
+        after = values - self.mean
+        self.m2 = self.m2 + (delta.real * after.real + 1.0j * delta.imag * after.imag)
+
+    # standard error of the mean, complex like the values, infinite until two values are in
+    def stdErr(self):
+        if self.count < 2: return numpy.full(numpy.shape(self.mean), complex(math.inf, math.inf))
+        m2 = numpy.asarray(self.m2) / ((self.count - 1) * self.count)
+        return numpy.sqrt(m2.real) + 1.0j * numpy.sqrt(m2.imag)
+
+    # standard error relative to the magnitude of the mean, per value
+    def relError(self):
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            return numpy.abs(self.stdErr()) / numpy.abs(self.mean)
+
+# incremental I/Q accumulator over the same burst windows as demodulate()
+# feed() takes captured stereo blocks of any size, in order, across point boundaries
+# onPoint(index, dotPrdts) is called as soon as the last window of a point is complete
+# with maxPoints given, only that many of the latest points are kept, for unbounded runs
+class Demodulator:
+    def __init__(self, tree, onPoint = None, maxPoints = None):
+        omega = 2.0 * math.pi * tree['freqHz'] / tree['rateS']
+        self.burstRange, halfPi, self.begins = burstWindows(tree)
+        self.refVec, self.squareNorm = refVector(omega, self.burstRange)
+        self.elapseS = tree['elapseS']
+        self.endS = max(self.begins) + self.burstRange
+        self.onPoint = onPoint
+        self.points = collections.deque(maxlen = maxPoints)
+        self.count = 0
+        self.reset()
+
+    # start accumulating a new point
+    def reset(self):
+        self.n = 0
+        self.sums = numpy.zeros((4, 2))
+
+    def feed(self, frames):
+        frames = numpy.frombuffer(frames, dtype = '<i2').reshape(-1, 2)
+        while len(frames):
+            take = min(len(frames), self.elapseS - self.n)
+            block, frames = frames[:take], frames[take:]
+
+            # add the part of each window that falls in this block
+            for w, begin in enumerate(self.begins):
+                lo = max(begin, self.n)
+                hi = min(begin + self.burstRange, self.n + take)
+                if lo < hi:
+                    self.sums[w] += self.refVec[lo - begin: hi - begin] @ block[lo - self.n: hi - self.n]
+
+            # combine in-phase and quadrature sums once all windows are complete
+            if self.n < self.endS <= self.n + take:
+                sums = self.sums / self.squareNorm
+                dotPrdts = sums[0::2] - 1.0j * sums[1::2]
+                self.points.append(dotPrdts.T.reshape(4))
+                if self.onPoint: self.onPoint(self.count, self.points[-1])
+                self.count += 1
+            self.n += take
+            if self.n == self.elapseS: self.reset()
+
+    # results so far, a (points, 4) complex array like demodulate()
+    def dotPrdts(self):
+        return numpy.array(list(self.points), dtype = complex).reshape(-1, 4)
+
+# read into a buffer until full, or until the end of the file
+# with follow set, wait for a file still being written, giving up after waitS without growth
+# returns the number of bytes read
+def readFull(rFile, buffer, follow = False, waitS = 2.0):
+    got = 0
+    idle = time.monotonic()
+    while got < len(buffer):
+        n = rFile.readinto(buffer[got:])
+        if n:
+            got += n
+            idle = time.monotonic()
+        elif follow and time.monotonic() - idle < waitS:
+            time.sleep(0.05)
+        else:
+            break
+    return got
+
+# demodulate a response file a block of points at a time, through one reused buffer,
+# so memory stays the same however long the capture
+# with follow set, points are analyzed as a capture still being written grows
+# yields (index, dotPrdts, lag) for each point, lag is 0 unless the tree has align set
+def streamPoints(tree, rName, follow = False, waitS = 2.0):
+    with wave.open(rName, 'rb') as mFile:
+        if mFile.getsampwidth() != 2 or mFile.getnchannels() != 2:
+            raise ValueError('Expected 16-bit stereo samples in: {0}'.format(rName))
+    offset, size = waveDataChunk(rName)
+    elapseS = tree['elapseS']
+    numPts = tree['numPts'] if follow else min(tree['numPts'], size // (4 * elapseS))
+    blockPts = 1 if follow else max(1, (1 << 24) // (4 * elapseS))
+    buffer = numpy.empty((blockPts * elapseS, 2), dtype = '<i2')
+    lags = lagRange(tree)
+    index = 0
+    with open(rName, 'rb') as rFile:
+        rFile.seek(offset)
+        while index < numPts:
+            wantPts = min(blockPts, numPts - index)
+            view = memoryview(buffer).cast('B')[:4 * wantPts * elapseS]
+            gotPts = readFull(rFile, view, follow, waitS) // (4 * elapseS)
+            if not gotPts: break
+            frames = buffer[:gotPts * elapseS]
+            offsets = numpy.zeros(gotPts, dtype = int)
+            if tree.get('align', False):
+                offsets[:] = [responseLag(tree, frames[p * elapseS: (p + 1) * elapseS], lags) for p in range(gotPts)]
+            dotPrdts = demodulate(dict(tree, numPts = gotPts), frames[:, 0], frames[:, 1], offsets)
+            for p in range(gotPts):
+                yield index + p, dotPrdts[p], int(offsets[p])
+            index += gotPts
+            if gotPts < wantPts: break
+
+# Demodulator that first aligns each point with its stimulus
+# keeps one point of frames, then finds its response lag and demodulates shifted windows
+# in a thread of its own, off the audio thread; onPoint is called from that thread
+class AlignedDemodulator:
+    def __init__(self, tree, onPoint = None, maxPoints = None):
+        self.tree = dict(tree, numPts = 1)
+        self.lagRange = lagRange(tree)
+        self.elapseS = tree['elapseS']
+        self.frames = numpy.empty((self.elapseS, 2), dtype = '<i2')
+        self.onPoint = onPoint
+        self.results = collections.deque(maxlen = maxPoints)
+        self.thread = None
+        self.count = 0
+        self.n = 0
+
+    def feed(self, frames):
+        frames = numpy.frombuffer(frames, dtype = '<i2').reshape(-1, 2)
+        while len(frames):
+            take = min(len(frames), self.elapseS - self.n)
+            self.frames[self.n: self.n + take] = frames[:take]
+            frames = frames[take:]
+            self.n += take
+            if self.n == self.elapseS:
+                self.thread = threading.Thread(target = self.analyze, args = (self.thread, self.frames))
+                self.thread.start()
+                self.frames = numpy.empty((self.elapseS, 2), dtype = '<i2')
+                self.n = 0
+
+    # points are analyzed concurrently, but stored in order once the previous point is done
+    def analyze(self, previous, frames):
+        lag = responseLag(self.tree, frames, self.lagRange)
+        point = demodulate(self.tree, frames[:, 0], frames[:, 1], lag)[0]
+        if previous: previous.join()
+        self.results.append((lag, point))
+        if self.onPoint: self.onPoint(self.count, point)
+        self.count += 1
+
+    # results of completed points, in order, once their analysis has finished
+    @property
+    def points(self):
+        if self.thread: self.thread.join()
+        return [point for lag, point in self.results]
+
+    @property
+    def lags(self):
+        if self.thread: self.thread.join()
+        return [lag for lag, point in self.results]
+
+    # results so far, a (points, 4) complex array like demodulate()
+    def dotPrdts(self):
+        return numpy.array(self.points, dtype = complex).reshape(-1, 4)
+
+# writes frames to a wave file from a background thread, keeping disk I/O off the audio thread
+class WaveSink:
+    def __init__(self, wName, rateS, nframes):
+        self.wFile = wave.open(wName, 'wb')
+        self.wFile.setparams((2, 2, rateS, nframes, 'NONE', ''))
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frames = self.queue.get()
+            if frames is None: break
+            self.wFile.writeframes(frames)
+
+    # frames must not change after this call, bytes or read-only arrays are fine
+    def write(self, frames):
+        self.queue.put(frames)
+
+    # wait for queued frames, then close the file
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.wFile.close()
+
+# excitation that brings detector amplitudes of both bursts to targetA
+# returns updated leftA and rightB, keeping their ratio when limited to 32000
+def levelUpdate(tree, dotPrdtA, dotPrdtB, targetA = 12000.0):
+    leftA  = tree['leftA']  * targetA / abs(dotPrdtA)
+    rightB = tree['rightB'] * targetA / abs(dotPrdtB)
+    if 32000 < leftA:
+        rightB = 32000.0 * rightB / leftA
+        leftA  = 32000
+    if 32000 < rightB:
+        leftA  = 32000.0 * leftA / rightB
+        rightB = 32000
+    return {'leftA': leftA, 'rightB': rightB}
+
+# given an impedance ratio, first burst excitation that nulls the bridge
+def nullUpdate(zRatio, amplA = 12000):
+    magn = abs(zRatio)
+    update = {'phaseA': cmath.phase(zRatio), 'leftA': amplA, 'rightA': amplA}
+    if magn > 1.0:
+        update['rightA'] = -amplA / magn
+    else:
+        update['leftA'] = -amplA * magn
+    return update
+
+# given an impedance ratio and reference impedance, compute the unknown impedance
+# returns z2 and its parallel resistance and capacitance
+# TODO consider complex reference impedance
+def refImpedance(tree, zRatio, freqHz):
+    z1 = cmath.rect(tree['zRef'], 0.0)
+    z2 = z1 / zRatio
+    y2 = 1.0 / z2
+    r2 = 1.0 / y2.real
+    c2 = y2.imag / 2.0 / math.pi / freqHz
+    return z2, r2, c2
+
+# replace z2 with a short circuit to calibrate detector gain and phase
+# returns detector gain as a complex value, excitation gain as an absolute value
+# TODO excitation gain may include phase later
+def calGains(tree, dotPrdtB, dotPrdtD):
+    detGain = dotPrdtB / dotPrdtD
+    excGain = abs(dotPrdtD) / tree['rightB']
+    return detGain, excGain
+
+# replace z2 with an open circuit to obtain ratio of zDet/z1, using detGain and excGain from the tree
+# returns detector impedance and its parallel resistance and capacitance
+def detImpedance(tree, dotPrdtA, dotPrdtD):
+    excLeft = tree['leftA'] * cmath.rect(tree['excGain'], cmath.phase(dotPrdtD))
+    detLeft = dotPrdtA / cmath.rect(*(tree['detGain']))
+    zDetRatio = detLeft / (excLeft - detLeft)
+    zDet = cmath.rect(tree['zRef'], 0.0) * zDetRatio
+    yDet = 1.0 / zDet
+    rDet = 1.0 / yDet.real
+    cDet = yDet.imag / 2.0 / math.pi / tree['freqHz']
+    return zDet, rDet, cDet
+
+# log-spaced frequencies from first to last, inclusive
+def logSweep(firstHz, lastHz, numFreq):
+    return [float(f) for f in numpy.geomspace(firstHz, lastHz, int(numFreq))]
+
+# multi-tone demodulation window, the middle half of each burst
+# returns window length and begin offsets for bursts A and B
+def toneWindows(tree):
+    windowS = tree['timeS'] // 2
+    beginA = tree['quietS'] + (tree['timeS'] // 4)
+    beginB = (tree['quietS'] * 2) + tree['timeS'] * 5 // 4
+    return windowS, (beginA, beginB)
+
+# snap frequencies to whole cycles over the multi-tone window, so tones are orthogonal
+# returns sorted distinct tone frequencies within the same limits as fitParams()
+def fitTones(tree, freqsHz):
+    windowS = toneWindows(tree)[0]
+    binHz = tree['rateS'] / windowS
+    bins = {round(min(10000.0, max(10.0, f)) / binHz) for f in freqsHz}
+    return [k * binHz for k in sorted(bins) if 0 < k < windowS // 2]
+
+# complex reference per tone, one column for each
+@functools.lru_cache(maxsize = 8)
+def toneMatrix(omegas, windowS):
+    refMat = numpy.exp(-1.0j * numpy.outer(numpy.arange(windowS) + 0.5, omegas))
+    refMat.flags.writeable = False
+    return refMat
+
+# sum of tones with Schroeder phases to keep crest factor low
+def toneSum(timeS, omegas, phase):
+    k = numpy.arange(len(omegas))
+    offsets = -math.pi * k * (k - 1) / len(omegas) + phase
+    return numpy.sin(numpy.outer(numpy.arange(timeS) + 0.5, omegas) + offsets).sum(axis = 1)
+
+# multi-tone version of the quiet, burst A, quiet, burst B schedule
+# one scale for all bursts and channels, so every tone keeps the amplitude ratios of the tree
+@functools.lru_cache(maxsize = 4)
+def toneScheduleFrames(rateS, tonesHz, quietS, timeS, leftA, rightA, phaseA, leftB, rightB, phaseB):
+    omegas = 2.0 * math.pi * numpy.array(tonesHz) / rateS
+    sums = [toneSum(timeS, omegas, p / 2.0) for p in (phaseA, -phaseA, phaseB, -phaseB)]
+    scale = 1.0 / max(numpy.max(numpy.abs(s)) for s in sums)
+    frames = numpy.zeros((2 * quietS + 2 * timeS, 2))
+    for c, (amplA, amplB) in enumerate(((leftA, leftB), (rightA, rightB))):
+        frames[quietS: quietS + timeS, c] = amplA * scale * sums[c]
+        frames[2 * quietS + timeS:, c] = amplB * scale * sums[2 + c]
+    frames = numpy.rint(frames).astype('<i2')
+    frames.flags.writeable = False
+    return frames
+
+# return multi-tone stimulus for one measurement point as an (elapseS, 2) int16 array
+def toneStimulusFrames(tree, tonesHz):
+    keys = tuple(tree[k] for k in stimKeys)
+    return toneScheduleFrames(keys[0], tuple(tonesHz), *keys[2:])
+
+# demodulate every tone of both bursts of all points in one pass
+# returns a (numPts, tones, 4) complex array holding dotPrdtA..D for each tone
+def demodulateTones(tree, tonesHz, mSeries, nSeries, startOffs = 0):
+    windowS, begins = toneWindows(tree)
+    omegas = tuple(2.0 * math.pi * f / tree['rateS'] for f in tonesHz)
+    refMat = toneMatrix(omegas, windowS)
+    numPts = tree['numPts']
+    if len(mSeries) < startOffs + numPts * tree['elapseS']:
+        raise ValueError('Response has {0} samples, {1} points need {2}.'.format(
+            len(mSeries), numPts, startOffs + numPts * tree['elapseS']))
+    starts = (startOffs + tree['elapseS'] * numpy.arange(numPts))[:, None] + numpy.array(begins)
+    dotPrdts = numpy.empty((numPts, len(omegas), 4), dtype = complex)
+    for c, series in enumerate((mSeries, nSeries)):
+        proj = projectWindows(numpy.asarray(series), starts, refMat).reshape(numPts, 2, -1)
+        dotPrdts[:, :, 2 * c: 2 * c + 2] = proj.transpose(0, 2, 1) / (windowS / 2.0)
+    return dotPrdts
+
+# multi-tone counterpart of Demodulator, same feed() interface
+# keeps one point of frames and demodulates it once its burst B window is complete
+class ToneDemodulator:
+    def __init__(self, tree, tonesHz, onPoint = None, maxPoints = None):
+        self.tree = dict(tree, numPts = 1)
+        self.tonesHz = tuple(tonesHz)
+        windowS, begins = toneWindows(tree)
+        self.elapseS = tree['elapseS']
+        self.endS = begins[1] + windowS
+        self.frames = numpy.zeros((self.elapseS, 2), dtype = '<i2')
+        self.onPoint = onPoint
+        self.points = collections.deque(maxlen = maxPoints)
+        self.count = 0
+        self.n = 0
+
+    def feed(self, frames):
+        frames = numpy.frombuffer(frames, dtype = '<i2').reshape(-1, 2)
+        while len(frames):
+            take = min(len(frames), self.elapseS - self.n)
+            self.frames[self.n: self.n + take] = frames[:take]
+            frames = frames[take:]
+            if self.n < self.endS <= self.n + take:
+                self.points.append(demodulateTones(self.tree, self.tonesHz,
+                    self.frames[:, 0], self.frames[:, 1])[0])
+                if self.onPoint: self.onPoint(self.count, self.points[-1])
+                self.count += 1
+            self.n += take
+            if self.n == self.elapseS: self.n = 0
+
+    # results so far, a (points, tones, 4) complex array like demodulateTones()
+    def dotPrdts(self):
+        return numpy.array(list(self.points), dtype = complex).reshape(-1, len(self.tonesHz), 4)
+
+# default device model for synthetic captures, override any key with synthModel in the tree
+# z1 is zRef, left input reads the detector node, right input reads the right output
+synthDefaults = {
+    'r2':      100e6, # unknown parallel resistance, ohms
+    'c2':      1e-12, # unknown parallel capacitance, farads
+    'rDet':      0.0, # detector input resistance, ohms, zero for none
+    'detGain':   1.0, # detector gain
+    'detPhase':  0.0, # detector phase, radians
+    'lagS':      0.0, # response latency, samples
+    'noise':     0.0, # additive noise, rms counts
+    'seed':        0  # noise generator seed
+}
+
+# response of the bridge model to one point of stimulus, before noise
+# the schedule repeats every point, so filtering is circular over elapseS
+def synthResponse(tree, stimFrames, model):
+    rateS = tree['rateS']
+    omegas = 2.0 * math.pi * numpy.fft.rfftfreq(len(stimFrames), 1.0 / rateS)
+    y1 = 1.0 / tree['zRef']
+    y2 = 1.0 / model['r2'] + 1.0j * omegas * model['c2']
+    yDet = 1.0 / model['rDet'] if model['rDet'] else 0.0
+    lag = numpy.exp(-1.0j * omegas * model['lagS'] / rateS)
+
+    # detector node divides left and right outputs through z1 and z2
+    spectra = numpy.fft.rfft(stimFrames, axis = 0)
+    detGain = cmath.rect(model['detGain'], model['detPhase'])
+    left = detGain * lag * (y1 * spectra[:, 0] + y2 * spectra[:, 1]) / (y1 + y2 + yDet)
+    right = lag * spectra[:, 1]
+    return numpy.fft.irfft(numpy.stack((left, right), axis = 1), n = len(stimFrames), axis = 0)
+
+# synthesize numPts points of stimulus and modeled response
+# yields (stimulus, response) int16 frame arrays, one pair per point
+def synthPoints(tree, model = None):
+    model = dict(synthDefaults, **(model or {}))
+    stimFrames = stimulusFrames(tree)
+    response = synthResponse(tree, stimFrames, model)
+    rng = numpy.random.default_rng(model['seed'])
+    for n in range(tree['numPts']):
+        respFrames = response
+        if model['noise']:
+            respFrames = response + rng.normal(0.0, model['noise'], response.shape)
+        yield stimFrames, numpy.clip(numpy.rint(respFrames), -32768, 32767).astype('<i2')
@@ -0,0 +1,171 @@
+''' File: acServer.py
+    Network measurement server for acBridge.py, in the manner of the iOS ImpBridge app.
+    Listens for UDP datagrams and TCP lines on the same port, 54321 by default.
+    A request is either an acBridge prompt command (meas, calc, fit, key value, ...),
+    a JSON object merged into the parameter tree, or an iOS client request such as
+    {"seq":1,"freq":160,"meas":[{"left":[12000,0],"right":[0,0]},{"left":[0,0],"right":[12000,0]}]}
+    Requests from all clients are queued and run one at a time, each reply is one JSON line.
+    A stop request ends a run command in progress.
+    Usage: python acServer.py [setup] [port]
+'''
+
+import asyncio, cmath, json, sys
+import numpy
+import acBridge
+
+# same port as the iOS app
+defaultPort = 54321
+
+# pending requests beyond which clients are told the server is busy
+maxQueue = 64
+
+# latest points of a run returned in a reply, the rest are summarized by count
+replyPts = 20
+
+# largest reply that fits in one UDP datagram
+maxDatagram = 65507
+
+# convert results to JSON-friendly values, complex as [real, imag] like the iOS app
+def jsonValue(value):
+    if isinstance(value, dict): return {k: jsonValue(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)): return [jsonValue(v) for v in value]
+    if isinstance(value, numpy.ndarray): return jsonValue(value.tolist())
+    if isinstance(value, complex): return [value.real, value.imag]
+    if isinstance(value, numpy.generic): return jsonValue(value.item())
+    return value
+
+# translate an iOS client burst list into amplitudes and phases of the parameter tree
+# each burst gives left and right excitation as [real, imag]
+def iosUpdate(request):
+    update = {}
+    if 'freq' in request: update['freqHz'] = float(request['freq'])
+    for burst, name in zip(request['meas'], ('A', 'B')):
+        left, right = complex(*burst['left']), complex(*burst['right'])
+        update['left' + name] = abs(left)
+        update['right' + name] = abs(right)
+        update['phase' + name] = cmath.phase(left) - cmath.phase(right)
+    return update
+
+# run one request in the bridge, return reply as a dict
+def runRequest(text):
+    try:
+        request = json.loads(text)
+    except ValueError:
+        request = None
+
+    # JSON object, from an iOS client or a parameter update
+    if isinstance(request, dict):
+        reply = dict(request)
+        request = dict(request)
+        if 'meas' in request:
+            acBridge.pTree.update(iosUpdate(request))
+            request.pop('freq', None)
+            request.pop('meas')
+        request.pop('seq', None)
+        acBridge.pTree.update(request)
+        if 'meas' in reply:
+            result = acBridge.runCommand('meas')
+            if not result: return dict(reply, fail = 'Measurement stopped!')
+
+            # detector response of each burst, as the iOS app reports it, from the last point
+            # mic is the left channel, bkg the right channel
+            dotPrdtA, dotPrdtB, dotPrdtC, dotPrdtD = map(complex, result['dotPrdts'][-1])
+            reply['meas'] = [dict(burst) for burst in reply['meas']]
+            for burst, mic, bkg in zip(reply['meas'], (dotPrdtA, dotPrdtB), (dotPrdtC, dotPrdtD)):
+                burst['mic'], burst['bkg'] = jsonValue(mic), jsonValue(bkg)
+            reply['result'] = jsonValue(result)
+        return reply
+
+    # prompt command, a run replies with its latest replyPts points
+    result = acBridge.runCommand(text)
+    if isinstance(result, dict) and replyPts < len(result.get('points', ())):
+        result = dict(result, points = result['points'][-replyPts:])
+    reply = {'cmd': text, 'result': jsonValue(result)}
+    if acBridge.commandWord(text) in ('show', 'fit'): reply['pTree'] = jsonValue(acBridge.pTree)
+    return reply
+
+# queue of (text, reply callback), served one at a time off the event loop
+class BridgeServer:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxQueue)
+
+    # queue a request, or reply at once when the queue is full
+    # stop is not queued, it ends a run in progress
+    def submit(self, text, respond):
+        text = text.strip()
+        if not text: return
+        if text == 'stop':
+            acBridge.stopEvent.set()
+            respond({'cmd': text})
+            return
+        try:
+            self.queue.put_nowait((text, respond))
+        except asyncio.QueueFull:
+            respond({'fail': 'Server is busy!'})
+
+    # measurements block on audio, so run them in a worker thread and await completion
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            text, respond = await self.queue.get()
+            try:
+                reply = await loop.run_in_executor(None, runRequest, text)
+            except Exception as e:
+                reply = {'cmd': text, 'fail': '{0}: {1}'.format(type(e).__name__, e)}
+            respond(reply)
+
+# one reply datagram per request datagram
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        def respond(reply):
+            data = json.dumps(reply).encode() + b'\n'
+            if maxDatagram < len(data):
+                data = json.dumps({'cmd': reply.get('cmd'), 'fail': 'Reply too large for UDP, use TCP!'}).encode() + b'\n'
+            self.transport.sendto(data, addr)
+        self.server.submit(data.decode(errors = 'replace'), respond)
+
+async def main(port):
+    acBridge.pTree['plot'] = False
+    server = BridgeServer()
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: UdpProtocol(server), local_addr = ('0.0.0.0', port))
+
+    # one request per line over TCP, replies in request order
+    # lines are read while earlier requests run, so a stop can follow a run on one connection
+    async def tcpClient(reader, writer):
+        pending = asyncio.Queue()
+        async def sendReplies():
+            while (done := await pending.get()) is not None:
+                writer.write(json.dumps(await done).encode() + b'\n')
+                await writer.drain()
+        sender = asyncio.create_task(sendReplies())
+        while line := await reader.readline():
+            if not line.strip(): continue
+            done = loop.create_future()
+            server.submit(line.decode(errors = 'replace'),
+                lambda reply, done = done: done.done() or done.set_result(reply))
+            pending.put_nowait(done)
+        pending.put_nowait(None)
+        await sender
+        writer.close()
+    tcpServer = await asyncio.start_server(tcpClient, '0.0.0.0', port)
+    print ('acServer listening on UDP and TCP port {0}'.format(port))
+    try:
+        await server.serve()
+    finally:
+        transport.close()
+        tcpServer.close()
+        acBridge.closeStreams()
+
+if __name__ == '__main__':
+    if 1 < len(sys.argv):
+        acBridge.loadParamTree('load ' + sys.argv[1])
+    port = int(sys.argv[2]) if 2 < len(sys.argv) else defaultPort
+    asyncio.run(main(port))
@@ -0,0 +1,342 @@
+''' File: acSession.py
+    One bridge on one audio device, for acBridge.py and acStation.py.
+    A session owns its parameter tree, audio streams, callback counters,
+    streaming demodulator and wave files, so several bridges can run
+    at once from one process, each on its own device.
+    Audio devices open on first measurement.
+'''
+
+import json, threading, time, numpy
+import acEngine, acStats
+
+pyaudio = None              # Python Audio module, imported with streams
+
+# streams and state of one bridge
+# the device key of the parameter tree selects input and output device, default devices if absent
+# a stop event given by the caller may be shared by several sessions, and is cleared by the caller
+class BridgeSession:
+    def __init__(self, pTree, stats = None, stopEvent = None, name = None):
+        self.pTree = pTree                  # measurement parameter tree
+        self.stats = stats or acStats.Stats() # stage timing and audio status counters
+        self.stopEvent = stopEvent or threading.Event() # ends a run at the next callback
+        self.ownStop = stopEvent is None    # stop event is cleared at the start of each run
+        self.name = name                    # prefix for printed lines, none for a single bridge
+        self.pa = None                      # Python Audio subsystem
+        self.playStream = None              # stereo output stream, or full-duplex stream
+        self.recStream = None               # stereo input stream, none when full-duplex
+        self.mode = None                    # (device, rateS, duplex) streams were opened with
+        self.inLate = self.outLate = 0.0    # stream latencies in seconds
+        self.stimWave = None                # stimulus wave file
+        self.respWave = None                # response wave file, or capture file when compact
+        self.stimFrames = None              # stimulus schedule for one measurement
+        self.loopFrames = None              # two schedules back to back, for slicing across point boundaries
+        self.runS = None                    # frames per stream run, none to run until stopped
+        self.demod = None                   # streaming demodulator for last measurement
+        self.pending = None                 # (number, tree, stimFrames, loopFrames) to play from the next point
+        self.applied = 0                    # number of the last pending stimulus played
+        self.playPoint = 0                  # point the play callback is in
+        self.changes = []                   # (first point, tree) of each stimulus played in this run
+
+        # callback counters, in frames, and completion events
+        self.playN = self.recN = self.duplexN = 0
+        self.delayS = 0
+        self.playDone = threading.Event()
+        self.recDone = threading.Event()
+        self.duplexDone = threading.Event()
+
+    @property
+    def device(self):
+        return self.pTree.get('device')
+
+    def log(self, text):
+        print (text if self.name is None else '{0}: {1}'.format(self.name, text.strip()))
+
+    # stimulus for frames first to last of a stream run, repeating every point, silent after runS
+    # a pending stimulus replaces the schedule once a callback starts within the next point,
+    # while the frames of the previous callback that ran into it were quiet in either schedule
+    def stimSlice(self, first, last):
+        point = first // len(self.stimFrames)
+        if point != self.playPoint:
+            self.playPoint = point
+            pending = self.pending
+            if pending and pending[0] != self.applied:
+                self.applied, tree, self.stimFrames, self.loopFrames = pending
+                self.changes.append((point, tree))
+        offset = first % len(self.stimFrames)
+        if self.runS is None or last <= self.runS:
+            return self.loopFrames[offset: offset + last - first]
+        frames = numpy.zeros((last - first, 2), dtype = '<i2')
+        if first < self.runS: frames[:self.runS - first] = self.loopFrames[offset: offset + self.runS - first]
+        return frames
+
+    # play callback returns a slice of the precomputed stimulus waveform
+    def playCall(self, in_data, frame_count, time_info, status_flags):
+        begin = time.perf_counter()
+        theFlag = pyaudio.paContinue
+        first = self.playN
+        self.playN = first + frame_count
+        if self.runS is not None and self.runS <= self.playN:
+            self.playN = max(first, self.runS)
+            theFlag = pyaudio.paComplete
+        if self.stopEvent.is_set(): theFlag = pyaudio.paComplete
+        frames = self.stimSlice(first, self.playN)
+        if self.stimWave: self.stimWave.write(frames)
+        self.stats.record('playCall', time.perf_counter() - begin, status_flags)
+        if theFlag == pyaudio.paComplete: self.playDone.set()
+        return (frames, theFlag)
+
+    # record callback demodulates response waveform as it is captured
+    def recCall(self, in_data, frame_count, time_info, status_flags):
+        begin = time.perf_counter()
+        theFlag = pyaudio.paContinue
+        if self.runS is not None and self.runS < (self.recN + frame_count):
+            nFrames = max(0, self.runS - self.recN)
+            self.recN += nFrames
+            nBytes = nFrames * (len(in_data) // frame_count)
+            in_data = in_data[:nBytes]
+            theFlag = pyaudio.paComplete
+        else:
+            self.recN += frame_count
+        if self.stopEvent.is_set(): theFlag = pyaudio.paComplete
+        self.demod.feed(in_data)
+        if self.respWave: self.respWave.write(in_data)
+        self.stats.record('recCall', time.perf_counter() - begin, status_flags)
+        if theFlag == pyaudio.paComplete: self.recDone.set()
+        return (bytes(), theFlag)
+
+    # full-duplex callback plays stimulus and records response in the same block
+    # input is dropped for the first delayS frames, output is silent for the last delayS frames,
+    # so response sample n always lines up with stimulus sample n, delayed by the stream latency
+    def duplexCall(self, in_data, frame_count, time_info, status_flags):
+        begin = time.perf_counter()
+        theFlag = pyaudio.paContinue
+        first = self.duplexN
+        self.duplexN = first + frame_count
+        if self.runS is not None and self.runS + self.delayS <= self.duplexN:
+            self.duplexN = max(first, self.runS + self.delayS)
+            theFlag = pyaudio.paComplete
+        if self.stopEvent.is_set(): theFlag = pyaudio.paComplete
+        frames = self.stimSlice(first, self.duplexN)
+        if self.stimWave and first < self.runS: self.stimWave.write(frames[:self.runS - first])
+
+        # keep input from delayS on
+        skip = max(0, self.delayS - first)
+        if skip < self.duplexN - first:
+            frameBytes = len(in_data) // frame_count
+            in_data = in_data[skip * frameBytes: (self.duplexN - first) * frameBytes]
+            self.demod.feed(in_data)
+            if self.respWave: self.respWave.write(in_data)
+        self.stats.record('duplexCall', time.perf_counter() - begin, status_flags)
+        if theFlag == pyaudio.paComplete: self.duplexDone.set()
+        return (frames, theFlag)
+
+    # open audio streams on first use, or again when device, sample rate or duplex has changed
+    def openStreams(self):
+        global pyaudio
+        duplex = self.pTree.get('duplex', False)
+        mode = (self.device, self.pTree['rateS'], duplex)
+        if self.playStream and self.mode == mode: return
+        self.closeStreams()
+        with self.stats.stage('open'):
+            import pyaudio
+            self.pa = pyaudio.PyAudio()
+            self.mode = mode
+
+            # send stimulus to stereo output, and receive response in the same stream if duplex
+            self.playStream = self.pa.open(
+                format = pyaudio.paInt16,
+                channels = 2,
+                rate = self.pTree['rateS'],
+                frames_per_buffer = 1024,
+                stream_callback = self.duplexCall if duplex else self.playCall,
+                input = duplex,
+                output = True,
+                input_device_index = self.device if duplex else None,
+                output_device_index = self.device,
+                start = False)
+
+            # otherwise receive response from separate stereo input
+            if not duplex:
+                self.recStream = self.pa.open(
+                    format = pyaudio.paInt16,
+                    channels = 2,
+                    rate = self.pTree['rateS'],
+                    frames_per_buffer = 1024,
+                    stream_callback = self.recCall,
+                    input = True,
+                    input_device_index = self.device,
+                    start = False)
+
+        # wait for analog circuits to settle
+        with self.stats.stage('settle'):
+            time.sleep(1.0)
+
+        # check latency
+        self.inLate = (self.playStream if duplex else self.recStream).get_input_latency()
+        self.outLate = self.playStream.get_output_latency()
+        self.log (' Input latency: {0:.8f} \nOutput latency: {1:.8f}'.format(self.inLate, self.outLate))
+
+    # close audio streams if open
+    def closeStreams(self):
+        if self.recStream: self.recStream.close()
+        if self.playStream: self.playStream.close()
+        if self.pa: self.pa.terminate()
+        self.pa = self.playStream = self.recStream = None
+
+    # start streaming, demodulating, and optionally writing disk files
+    # given a list of tone frequencies, excite and demodulate them all at once
+    # with continuous set, all points play as one schedule in a single stream run
+    # given ringPts, points play until stopEvent is set, keeping only the last ringPts results
+    # onPoint(index, dotPrdts) is passed to the demodulator, poll() is called while waiting
+    # returns the demodulator holding the results
+    def startStreaming(self, tonesHz = None, ringPts = None, onPoint = None, poll = None):
+        self.openStreams()
+        if self.ownStop: self.stopEvent.clear()
+        continuous = self.prepareRun(tonesHz, ringPts, onPoint)
+        runs = 1 if continuous else self.pTree['numPts']
+        runName = 'stream' if continuous else 'point'
+        if self.pTree.get('duplex', False):
+            self.duplexStreaming(runs, runName, poll)
+        else:
+            self.simplexStreaming(runs, runName, poll)
+
+        # close disk files, waiting for writer threads to finish
+        with self.stats.stage('write'):
+            if self.respWave: self.respWave.close()
+            if self.stimWave: self.stimWave.close()
+        self.respWave = self.stimWave = None
+        return self.demod
+
+    # stimulus, demodulator, run length and disk files for the callbacks, no streams are needed
+    # returns true when all points play in one stream run
+    def prepareRun(self, tonesHz = None, ringPts = None, onPoint = None):
+        pTree = self.pTree
+
+        # compute stimulus once, outside the audio callback
+        if tonesHz:
+            self.stimFrames = acEngine.toneStimulusFrames(pTree, tonesHz)
+            self.demod = acEngine.ToneDemodulator(pTree, tonesHz, onPoint, ringPts)
+        else:
+            self.stimFrames = acEngine.stimulusFrames(pTree)
+            if pTree.get('align', False):
+                self.demod = acEngine.AlignedDemodulator(pTree, onPoint, ringPts)
+            else:
+                self.demod = acEngine.Demodulator(pTree, onPoint, ringPts)
+        self.loopFrames = numpy.concatenate((self.stimFrames, self.stimFrames))
+        self.pending = None
+        self.applied = self.playPoint = 0
+        self.changes = [(0, dict(pTree))]
+
+        # one stream run per point, or one for all points
+        continuous = ringPts is not None or pTree.get('continuous', False)
+        self.playN = self.recN = self.duplexN = 0
+        if ringPts is not None: self.runS = None
+        else: self.runS = (pTree['numPts'] if continuous else 1) * pTree['elapseS']
+
+        # set up disk output files, written from background threads
+        # (wave library only supports uncompressed PCM format)
+        # a compact capture holds the response and results, the stimulus follows from the tree
+        self.stimWave = self.respWave = None
+        if pTree.get('archive', True) and self.runS is not None:
+            if pTree.get('compact', False):
+                import acCapture
+                self.respWave = acCapture.CaptureSink(pTree['fName'], pTree, self.demod, pTree.get('compress', True))
+            else:
+                self.stimWave = acEngine.WaveSink(pTree['fName'] + '-stim.wav', pTree['rateS'], pTree['elapseS'])
+                self.respWave = acEngine.WaveSink(pTree['fName'] + '-resp.wav', pTree['rateS'], pTree['elapseS'])
+        return continuous
+
+    # wait for a callback to complete, calling poll() meanwhile
+    # Ctrl-C stops the run at the next callback rather than leaving streams running
+    def waitDone(self, done, poll = None):
+        while True:
+            try:
+                if done.wait(0.1): break
+                if poll: poll()
+            except KeyboardInterrupt:
+                self.stopEvent.set()
+        if poll: poll()
+
+    # one full-duplex stream per run, completion signalled by its callback
+    def duplexStreaming(self, runs, runName, poll = None):
+        # stimulus is followed by silence while the last of the response arrives
+        self.delayS = round((self.inLate + self.outLate) * self.pTree['rateS'])
+        for m in range(runs):
+            if self.stopEvent.is_set(): break
+            runBegin = time.perf_counter()
+            self.duplexN = 0
+            self.duplexDone.clear()
+            self.playStream.start_stream()
+            self.waitDone(self.duplexDone, poll)
+            self.playStream.stop_stream()
+            self.stats.record(runName, time.perf_counter() - runBegin)
+            self.log ('Duplex count: {0}, delay: {1}'.format(self.duplexN, self.delayS))
+
+    # separate play and record streams per run, record started after the stream latency
+    def simplexStreaming(self, runs, runName, poll = None):
+        for m in range(runs):
+            if self.stopEvent.is_set(): break
+            runBegin = time.perf_counter()
+            self.playN = self.recN = 0
+            self.playDone.clear()
+            self.recDone.clear()
+            self.playStream.start_stream()
+
+            # delay recording to account for latency, align finds what remains
+            time.sleep(1.2 * (self.inLate + self.outLate))
+            recBegin = time.perf_counter()
+            self.recStream.start_stream()
+            self.log ('      CPU load: {0:.8f}'.format(self.playStream.get_cpu_load()))
+
+            # stop playback stream once its callback has completed
+            self.waitDone(self.playDone, poll)
+            self.playStream.stop_stream()
+            self.stats.record('play', time.perf_counter() - runBegin)
+            self.log ('Playback count: {0}'.format(self.playN))
+
+            # stop record stream once its callback has completed
+            self.waitDone(self.recDone, poll)
+            self.recStream.stop_stream()
+            self.stats.record('record', time.perf_counter() - recBegin)
+            self.stats.record(runName, time.perf_counter() - runBegin)
+            self.log ('  Record count: {0}'.format(self.recN))
+
+    # excitation for points played from now on, while streaming continuously
+    # the schedule is built here, off the audio thread, and swapped in at the next point
+    # timing keys must not change, only amplitudes and phases
+    def setStimulus(self, tree):
+        tree = dict(tree)
+        stimFrames = acEngine.stimulusFrames(tree)
+        number = (self.pending[0] if self.pending else self.applied) + 1
+        self.pending = (number, tree, stimFrames, numpy.concatenate((stimFrames, stimFrames)))
+
+    # frames of response recorded in the current or last stream run
+    def recordedFrames(self):
+        if self.pTree.get('duplex', False): return max(0, self.duplexN - self.delayS)
+        return self.recN
+
+    # end a stream run at the end of the point being recorded, rather than at the next callback,
+    # so every point demodulated is also whole in the archived capture
+    # runS may already have passed when the callbacks get here, they then complete at once
+    def finishPoint(self):
+        elapseS = self.pTree['elapseS']
+        self.runS = (self.recordedFrames() // elapseS + 1) * elapseS
+
+    # parameter tree that point n of the last run was played with
+    def pointTree(self, n):
+        for first, tree in reversed(self.changes):
+            if first <= n: return tree
+        return self.changes[0][1]
+
+    # write parameter tree to <fName>.json
+    def saveTree(self):
+        with self.stats.stage('save'), open(self.pTree['fName'] + '.json', 'w') as qFile:
+            json.dump(self.pTree, qFile, indent = 2)
+            qFile.write('\n')
+
+    # fit parameters, save them with the capture, and measure numPts points
+    # returns the demodulator holding the results
+    def measure(self):
+        acEngine.fitParams(self.pTree)
+        self.saveTree()
+        return self.startStreaming()
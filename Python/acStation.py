@@ -0,0 +1,154 @@
+''' File: acStation.py
+    Runs several bridges at once, one per audio device, from one process.
+    Each bridge is a session of its own (acSession.py) with its own parameter tree,
+    counters and disk files, measured on a thread pool or in one process per device.
+    Results of all bridges are written to one table with a row per point.
+    Usage: python acStation.py [-o station.csv] [-n passes] [--processes] device[:setup] ...
+           python acStation.py --list
+    Setups are acBridge.py setup files without the .json extension, setUp by default.
+    Output format follows the extension, as for acBatch.py.
+'''
+
+import argparse, concurrent.futures, json, os, sys, threading, time
+import acBatch, acBridge, acEngine, acSession
+
+# table columns, complex values are split into real and imaginary parts
+columns = ['device', 'fName', 'pass', 'point', 'freqHz', 'lagS', 'zRatioRe', 'zRatioIm',
+    'r2', 'c2', 'error']
+
+# ends the runs of every session in this process, cleared only when a station run starts
+stopEvent = threading.Event()
+
+# list audio devices with their channels and default rate
+def listDevices():
+    import pyaudio
+    pa = pyaudio.PyAudio()
+    print (' index  in out      rate  name')
+    for n in range(pa.get_device_count()):
+        info = pa.get_device_info_by_index(n)
+        print (' {0:5d} {1:3d} {2:3d} {3:9.0f}  {4}'.format(n, info['maxInputChannels'],
+            info['maxOutputChannels'], info['defaultSampleRate'], info['name']))
+    pa.terminate()
+
+# turn 'device[:setup]' arguments into (device, tree) pairs
+# file names get the position in specs appended when bridges would share them,
+# since the same device or default may be given more than once
+def loadSetups(specs):
+    setups = []
+    for spec in specs:
+        device, setup = spec.split(':', 1) if ':' in spec else (spec, 'setUp')
+        tree = acBridge.defaultParams()
+        tree['fName'] = setup
+        if os.path.exists(setup + '.json'):
+            with open(setup + '.json', 'r') as qFile:
+                tree.update(json.load(qFile) or {})
+        tree.update(device = None if device == 'default' else int(device), plot = False)
+        setups.append(tree)
+    fNames = [tree['fName'] for tree in setups]
+    for n, tree in enumerate(setups):
+        if 1 < fNames.count(tree['fName']):
+            tree['fName'] += '-{0}'.format(n)
+    return setups
+
+# one row per point of a measurement
+def pointRows(tree, number, demod):
+    dotPrdts = demod.dotPrdts()
+    lags = demod.lags if tree.get('align') else None
+    rows = []
+    for n, zRatio in enumerate(acEngine.zRatios(tree, dotPrdts)):
+        row = {'device': tree['device'], 'fName': tree['fName'], 'pass': number, 'point': n,
+            'freqHz': tree['freqHz'], 'lagS': None if lags is None else int(lags[n]),
+            'zRatioRe': zRatio.real, 'zRatioIm': zRatio.imag}
+        if tree.get('ref'):
+            z2, row['r2'], row['c2'] = acEngine.refImpedance(tree, complex(zRatio), tree['freqHz'])
+        rows.append(row)
+    return rows
+
+# measure one bridge for a number of passes, on a worker thread or in a worker process
+# streams are opened before timing, so throughput excludes the settling time
+# Ctrl-C in a worker process, between runs, stops its bridges with the rows so far
+# returns rows and a summary with the session's stage timing
+def runBridge(tree, passes):
+    baseName = tree['fName']
+    session = acSession.BridgeSession(tree, stopEvent = stopEvent, name = baseName)
+    rows = []
+    points = 0
+    begin = end = time.time()
+    try:
+        acEngine.fitParams(tree)
+        session.openStreams()
+        begin = time.time()
+        for number in range(passes):
+            if stopEvent.is_set(): break
+            if 1 < passes: tree['fName'] = '{0}-{1}'.format(baseName, number)
+            rows += pointRows(tree, number, session.measure())
+            points = len(rows)
+        end = time.time()
+    except KeyboardInterrupt:
+        stopEvent.set()
+        end = time.time()
+    except Exception as e:
+        rows.append({'device': tree['device'], 'fName': tree['fName'],
+            'error': '{0}: {1}'.format(type(e).__name__, e)})
+        begin = end = time.time()
+    finally:
+        session.closeStreams()
+    return rows, {'device': tree['device'], 'fName': baseName, 'points': points,
+        'begin': begin, 'end': end, 'stats': session.stats.summary()}
+
+# throughput of each bridge and of all of them together
+def report(summaries):
+    print (' device  points   seconds   points/s')
+    rates = []
+    for s in summaries:
+        seconds = s['end'] - s['begin']
+        rate = s['points'] / seconds if seconds else 0.0
+        if s['points']: rates.append(rate)
+        print (' {0:>6} {1:7d} {2:9.3f} {3:10.3f}  {4}'.format(str(s['device']), s['points'],
+            seconds, rate, s['fName']))
+    points = sum(s['points'] for s in summaries)
+    seconds = max(s['end'] for s in summaries) - min(s['begin'] for s in summaries)
+    combined = points / seconds if seconds else 0.0
+    single = sum(rates) / len(rates) if rates else 0.0
+    print (' Combined {0} points in {1:.3f} s, {2:.3f} points/s, {3:.2f} times one bridge.'.format(
+        points, seconds, combined, combined / single if single else 0.0))
+    return combined
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = 'Run several acBridge sessions at once.')
+    parser.add_argument('specs', nargs = '*', metavar = 'device[:setup]',
+        help = 'audio device index, or default, and setup file name')
+    parser.add_argument('-o', '--output', default = 'station.csv', help = '.csv, .jsonl or .parquet')
+    parser.add_argument('-n', '--passes', type = int, default = 1, help = 'measurements per bridge')
+    parser.add_argument('--processes', action = 'store_true', help = 'one process per device, not threads')
+    parser.add_argument('--list', action = 'store_true', help = 'list audio devices and exit')
+    args = parser.parse_args(argv)
+    if args.list or not args.specs:
+        listDevices()
+        return 0
+
+    setups = loadSetups(args.specs)
+    stopEvent.clear()
+    print ('Running {0} bridges in {1}.'.format(len(setups), 'processes' if args.processes else 'threads'))
+    pool = (concurrent.futures.ProcessPoolExecutor if args.processes
+        else concurrent.futures.ThreadPoolExecutor)(max_workers = len(setups))
+    with pool:
+        futures = [pool.submit(runBridge, tree, args.passes) for tree in setups]
+
+        # Ctrl-C stops every bridge at its next callback, results so far are kept
+        try:
+            concurrent.futures.wait(futures)
+        except KeyboardInterrupt:
+            stopEvent.set()
+        results = [future.result() for future in futures]
+
+    rows = [row for rowList, summary in results for row in rowList]
+    acBatch.writeTable(args.output, rows, columns)
+    report([summary for rowList, summary in results])
+    failed = [row for row in rows if 'error' in row]
+    for row in failed: print ('Device {0} failed: {1}'.format(row['device'], row['error']))
+    print ('Results written to: {0}'.format(args.output))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
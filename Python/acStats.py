@@ -0,0 +1,91 @@
+''' File: acStats.py
+    Timing and audio status counters for acBridge.py.
+    Stages are timed with a context manager, audio callbacks with record().
+    Totals are reported as a table, as JSON, or as Prometheus text.
+'''
+
+import contextlib, json, time
+
+# PortAudio callback status flags, as passed to stream callbacks
+statusFlags = {
+    'inputUnderflow':  0x01,
+    'inputOverflow':   0x02,
+    'outputUnderflow': 0x04,
+    'outputOverflow':  0x08,
+    'primingOutput':   0x10}
+
+# accumulated durations in seconds, and status flag counts, by name
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.flags = {}
+        self.begin = time.time()
+
+    # add one duration in seconds
+    # called from audio callbacks, so keep it to a few list operations
+    def record(self, name, seconds, status = 0):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds < timer[2]: timer[2] = seconds
+            if seconds > timer[3]: timer[3] = seconds
+            timer[4] = seconds
+        if status:
+            for flag, mask in statusFlags.items():
+                if status & mask:
+                    key = (name, flag)
+                    self.flags[key] = self.flags.get(key, 0) + 1
+
+    # time a block of code as one stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - begin)
+
+    # totals as a dict, durations in seconds
+    def summary(self):
+        return {
+            'uptime': time.time() - self.begin,
+            'stages': {name: {'count': t[0], 'total': t[1], 'mean': t[1] / t[0],
+                'min': t[2], 'max': t[3], 'last': t[4]} for name, t in self.timers.items()},
+            'flags': {'{0}.{1}'.format(*key): count for key, count in self.flags.items()}}
+
+    def toJson(self):
+        return json.dumps(self.summary(), indent = 2)
+
+    # Prometheus text exposition format, durations as summaries in seconds
+    def toPrometheus(self, prefix = 'acbridge'):
+        lines = ['# HELP {0}_stage_seconds Time spent per stage.'.format(prefix),
+            '# TYPE {0}_stage_seconds summary'.format(prefix)]
+        for name, t in self.timers.items():
+            lines.append('{0}_stage_seconds_count{{stage="{1}"}} {2}'.format(prefix, name, t[0]))
+            lines.append('{0}_stage_seconds_sum{{stage="{1}"}} {2:.9f}'.format(prefix, name, t[1]))
+        lines += ['# HELP {0}_stage_seconds_max Longest time spent in one stage.'.format(prefix),
+            '# TYPE {0}_stage_seconds_max gauge'.format(prefix)]
+        for name, t in self.timers.items():
+            lines.append('{0}_stage_seconds_max{{stage="{1}"}} {2:.9f}'.format(prefix, name, t[3]))
+        lines += ['# HELP {0}_status_flags_total Audio callbacks reporting each status flag.'.format(prefix),
+            '# TYPE {0}_status_flags_total counter'.format(prefix)]
+        for (name, flag), count in self.flags.items():
+            lines.append('{0}_status_flags_total{{stage="{1}",flag="{2}"}} {3}'.format(prefix, name, flag, count))
+        return '\n'.join(lines) + '\n'
+
+    # human-readable table, durations in milliseconds
+    def report(self):
+        lines = ['  stage         count    total ms     mean ms      max ms     last ms']
+        for name, t in self.timers.items():
+            lines.append('  {0:12s} {1:6d} {2:11.3f} {3:11.3f} {4:11.3f} {5:11.3f}'.format(
+                name, t[0], 1e3 * t[1], 1e3 * t[1] / t[0], 1e3 * t[3], 1e3 * t[4]))
+        for (name, flag), count in self.flags.items():
+            lines.append('  {0:12s} {1:6d} {2}'.format(name, count, flag))
+        if not self.timers: lines.append('  no stages recorded')
+        return '\n'.join(lines)